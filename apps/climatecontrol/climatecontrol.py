@@ -15,14 +15,14 @@
 #
 # climatecontrol:
 #   module: climatecontrol
-#   class: Mangage_Climate
+#   class: Mangage_Climate # or Manage_Climate_Async to send each transition's calls concurrently
 #   fhigh: "sensor.calwell_temp_max_0"
 #   flow: "sensor.calwell_temp_min_0"
 #   cexttemp: "sensor.tuggeranong_temp"
-#   cinttemp: "sensor.inside_now"
+#   cinttemp: "sensor.inside_now" # or several, "sensor.lounge_temp,sensor.hall_temp", fused into one
 #   solarstatus: "input_boolean.power_ready"
-#   presenceaway: "input_boolean.presence_away"
-#   exthigh: "input_number.cc_exthigh"
+#   presenceaway: "input_boolean.presence_away" # 'on' when everyone is away
+#   exthigh: "input_number.cc_exthigh" # the six have to go extlow < intlow < optlow < opthigh < inthigh < exthigh
 #   inthigh: "input_number.cc_inthigh"
 #   opthigh: "input_number.cc_opthigh"
 #   optlow: "input_number.cc_optlow"
@@ -32,18 +32,71 @@
 #   fan: "fan.master_fan,fan.staci_s_fan,fan.delia_s_fan,fan.lounge"
 #   heater: "climate.83607036e098068310e2,climate.83607036e09806830fb8,climate.33805060a4cf12d11732" # ensuite, study, lounge
 #   door: "binary_sensor.fdoor_open,binary_sensor.bdoor_open"
-#   acrule: "input_text.ac_rule"
+#   door_pause: 10 # optional, minutes doors can be open before the ac and heaters pause until they close, 0 (the default) for never
+#   acrule: "input_text.ac_rule" # where the rule in force is shown, with zones only used if there's just one
 #   warnlight: "light.front_hall"
 #   manual_override: "input_boolean.cc_ac_manual"
+#   zones: # optional, areas with their own sensor and devices, user values default to the ones above
+#     - name: "study"
+#       cinttemp: "sensor.study_temp"
+#       inthigh: "input_number.cc_study_inthigh"
+#       aircon: ""
+#       fan: ""
+#       heater: "climate.83607036e09806830fb8"
+#       acrule: "input_text.study_rule" # optional, the zone's rule isn't shown without it
+#   fusion: "median" # optional, how several inside sensors are combined, "median" or "mean"
+#   sensor_weights: {sensor.hall_temp: 0.5} # optional, for "mean", sensors not listed weigh 1
+#   smoothing: 300 # optional, seconds for the smoothed inside temperature to go 63% of the way to a new reading, 0 (the default) for none
+#   outlier: 3.0 # optional, degrees from the sensors' median (or with fewer than 3, the smoothed value) before a reading is ignored
+#   stale: 3600 # optional, seconds without hearing from a sensor (by HA's last_reported) before its reading is ignored
+#   resolution: 0.1 # optional, degrees the inside temperature has to move before it's decided on again
+#   hysteresis: 0.2 # optional, degrees past a user value before a test changes, or one per value eg {inthigh: 0.5}
+#   dwell: 300 # optional, minimum seconds to stay in a rule
+#   rule_dwell: {"Goldilocks": 600} # optional, minimum seconds for particular rules
+#   device_dwell: 180 # optional, minimum seconds between switching an ac or heater on/off
+#   rate_limit: 5 # optional, minimum seconds between sends to one device, or one per device eg {climate.lounge: 30}
+#   retries: 5 # optional, times a failed send is retried before giving up
+#   retry_backoff: 2 # optional, seconds before the first retry, doubling each time
+#   max_in_flight: 4 # optional, Manage_Climate_Async only, most service calls waiting on HA at once
+#   metrics_sensor: "sensor.climatecontrol_metrics" # optional, where the counters are published as attributes
+#   metrics_file: "/config/climatecontrol.prom" # optional, Prometheus text file for a local exporter to scrape
+#   metrics_interval: 300 # optional, seconds between publishing the counters
+#   telemetry_file: "/config/climatecontrol.ring" # optional, every evaluation kept in a ring buffer, read with tools/telemetry.py
+#   telemetry_size: 262144 # optional, evaluations kept before the oldest are overwritten, 28 bytes each
+#   power: # optional, start the ac and heaters one at a time, and under the solar rules only within a power budget
+#     budget: 3000 # watts to spare, used when there's no sensor or it's unavailable
+#     sensor: "sensor.solar_surplus" # optional, watts exported right now, read as it changes
+#     stagger: 30 # seconds between one device starting and the next
+#     devices: {climate.rushbrook_aircon: {draw: 2400, priority: 1}, climate.83607036e09806830fb8: {draw: 1000, priority: 2}}
+#   state_file: "/config/climatecontrol_state.json" # optional, where the controller's state is kept over a restart
+#   state_interval: 60 # optional, seconds between saving it when something changed
+#   windows: # optional, when the afternoon rules and the heater curfew apply, times quoted
+#     afternoon: {start: "14:00", end: "00:00"}
+#     heater_curfew: {start: "22:00", end: "05:00"}
+#   precondition: # optional, cool or heat ahead of time so the house is comfortable by a set time
+#     model: "/config/climatecontrol_model.json" # the thermal model of each zone, fitted by tools/thermal.py
+#     cool_by: "17:00" # when it should be no hotter than inthigh
+#     heat_by: "07:00" # when it should be no colder than intlow
+#     horizon: 8 # hours ahead we look, the forecast only goes so far
+#     every: 600 # seconds between predictions
 #
 ############################################################
 
 # import the function libraries
 #import requests
+import asyncio
 import datetime
-#import json
+import itertools
+import json
+import os
 import appdaemon.plugins.hass.hassapi as hass
 
+# the policy itself, which doesn't need AppDaemon
+from climatecore import (Metrics, OFF, SOLARRULES, Snapshot, Telemetry, ThermalModel, Thresholds, USERKEYS, USERVALUES,
+                         WINDOWS, Zone, batch, decide, devicestate, diff, drawing, entitylist, fit, inwindow, reads, timeofday,
+                         tofloat)
+
+
 class Manage_Climate(hass.Hass): 
 
     # the name of the flags in HA to use
@@ -51,33 +104,65 @@ class Manage_Climate(hass.Hass):
     FHIGHN = "" # Forecast High
     FLOWN = "" # Forecast Low
     CEXTEMPN = "" # current external temperature
-    CINTEMPN = "" # current internal temperature
     SOLARN = "" # Solar status 
     AWAYN = "" # Everyone away?
     MANUAL = "" # Manual override (ignore temp code)
 
-    # these are the names of the sensors
-    EXTHIGHN = "" # highest temp we are happy the house to get to ever
-    INTHIGHN = "" # highest temp we are happy to live with
-    OPTHIGHN = "" # highest temp we would prefer
-    OPTLOWN = "" # lowest temp we would prefer
-    INTLOWN = "" # lowest temp we are happy to live with
-    EXTLOWN = "" # lowest temp we are happy the houe to get to ever
-
-    # these are the values
-    EXTHIGH = "" # highest temp we are happy the house to get to ever
-    INTHIGH = "" # highest temp we are happy to live with
-    OPTHIGH = "" # highest temp we would prefer
-    OPTLOW = "" # lowest temp we would prefer
-    INTLOW = "" # lowest temp we are happy to live with
-    EXTLOW = "" # lowest temp we are happy the houe to get to ever
+    zones = [] # each area with its own inside sensor, user values and devices
+    zoneindex = {} # the zones that need a look when an entity changes
 
     FAN = [] # all the fans to control
     AIRCON = [] # all the climate controls we have access to
     HEATER = [] # all the heater only climate controls we have access to
     DOOR = [] # all the doors, windows etc that we need to consider closing when heating/cooling is running
     WARNLIGHT = [] # the lights to turn on to warn that doors/windows are open when heating/cooling is running
-    ACRULE = ""
+    insidesensors = set() # every zone's inside temperature sensors
+    asked = {} # when we last asked HA about each quiet inside sensor
+    ASKEVERY = 300 # seconds before asking about a quiet sensor again
+    opendoors = set() # the doors and windows open now
+    DOORPAUSE = 0 # seconds doors can be open before the ac and heaters pause, 0 for never
+    paused = False # the ac and heaters are off because doors have been open too long
+
+    cache = {} # last known state of every entity the app depends on
+    desired = {} # the state we want each device in
+    actual = {} # the last known state of each device
+    queue = {} # devices waiting to be sent their desired state: [aftype, failed attempts, not before]
+    waiting = set() # devices on the queue held back until there's the power to start them
+    lastsent = {} # when each device was last sent anything
+    holding = 0 # more than 0 while plans are being applied, so calls are batched
+
+    BAND = {} # hysteresis for each user value, how far past it we need to go to change
+    DWELL = 300 # minimum seconds to stay in a rule
+    RULEDWELL = {} # minimum seconds for particular rules
+    DEVICEDWELL = 180 # minimum seconds between switching an ac or heater on and off
+    RATE = 5 # minimum seconds between sends to one device
+    RATES = {} # the same for particular devices
+    RETRIES = 5 # times a failed send is tried again
+    BACKOFF = 2 # seconds before the first retry, doubling each time
+    POWER = False # whether starts are staggered and budgeted
+    BUDGET = 0.0 # watts to spare when there's no sensor
+    POWERSENSOR = None # the sensor giving the watts to spare now
+    STAGGER = 30 # seconds between starts
+    DRAW = {} # watts each device draws running
+    PRIORITY = {} # which devices start first, lowest first
+    unitzone = {} # the zone each device is in
+    laststart = None # when a device was last started
+    shed = None # the device last shed for power and when, until the sensor has had time to see it go
+    changed = {} # when each device was last switched
+    timers = {} # re-check timers for held rules and devices
+    metrics = None # the running counters
+    mark = None # the evaluation being timed, finished once its calls are sent
+    WINDOWS = {} # name: (start, end) times of each window
+    STATEFILE = None # where the controller's state is saved over a restart
+    dirty = False # something worth saving has changed since it was last saved
+    PREBY = {} # when the house should be cooled or heated by, with a thermal model
+    HORIZON = 8 # hours ahead the model looks
+    PREEVERY = 600 # seconds between predictions
+    window = set() # the windows we're in now
+    METRICSENSOR = "" # the HA sensor the counters are published to
+    METRICSFILE = None # the Prometheus text file they are written to
+    telemetry = None # the ring buffer every evaluation is recorded in
+    unrecorded = [] # the evaluations waiting for their calls to be sent before they're recorded
 
     tick_up_mdi = "mdi:arrow-top-right"
     tick_down_mdi = "mdi:arrow-bottom-left"
@@ -86,382 +171,570 @@ class Manage_Climate(hass.Hass):
     # run each step against the database
     def initialize(self):
 
+        self.cache = {}
+        self.desired = {}
+        self.actual = {}
+        self.queue = {}
+        self.lastsent = {}
+        self.holding = 0
+        self.changed = {}
+        self.timers = {}
+        self.metrics = Metrics()
+
         # get the values from the app.yaml that has the relevant personal settings
         self.FHIGHN = self.args["fhigh"]
         self.FLOWN = self.args["flow"]
         self.CEXTEMPN = self.args["cexttemp"]
-        self.CINTEMPN = self.args["cinttemp"]
         self.SOLARN = self.args["solarstatus"]
         
         self.MANUAL = self.args["manual_override"]
         
 
-        if self.args["presenceaway"] != 'home' or self.args["presenceaway"] != 'off':
-            self.AWAYN = 'on'
-        else:
-            self.AWAYN = 'off'
+        self.AWAYN = self.args["presenceaway"]
 
-        self.EXTHIGHN = self.args["exthigh"]
-        self.INTHIGHN = self.args["inthigh"]
-        self.OPTHIGHN = self.args["opthigh"]
-        self.OPTLOWN = self.args["optlow"]
-        self.INTLOWN = self.args["intlow"]
-        self.EXTLOWN = self.args["extlow"]
+        # the areas to control, without a zones list the whole house is one zone
+        if self.args.get("zones"):
+            self.zones = [Zone(z.get("name", "zone" + str(i)), z, self.args) for i, z in enumerate(self.args["zones"])]
+        else:
+            self.zones = [Zone("house", self.args)]
+        # the app's acrule only goes to a zone of its own
+        if len(self.zones) == 1 and self.zones[0].ACRULE is None:
+            self.zones[0].ACRULE = self.args.get("acrule")
+        elif self.args.get("acrule") and len(self.zones) > 1:
+            self.log("acrule is only used with a single zone, give each zone its own", level="WARNING")
 
         # get all the devices to control
-        self.FAN = [x.strip() for x in self.args["fan"].split(',')]
-        self.AIRCON = [x.strip() for x in self.args["aircon"].split(',')]
-        self.HEATER = [x.strip() for x in self.args["heater"].split(',')]
-        self.DOOR = [x.strip() for x in self.args["door"].split(',')]
-        self.WARNLIGHT = [x.strip() for x in self.args["warnlight"].split(',')]
-        self.ACRULE = self.args["acrule"]
-
-        # if the internal temperature or if everyone leaves, adjust the climate control
-        self.listen_state(self.main, self.CINTEMPN)
-        self.listen_state(self.main, self.AWAYN)
+        self.FAN = [x for z in self.zones for x in z.FAN]
+        self.AIRCON = [x for z in self.zones for x in z.AIRCON]
+        self.HEATER = [x for z in self.zones for x in z.HEATER]
+        self.DOOR = entitylist(self.args["door"])
+        self.WARNLIGHT = entitylist(self.args["warnlight"])
+
+        # which zones an entity feeds, the shared inputs feed all of them
+        self.zoneindex = {}
+        for zone in self.zones:
+            for entity in zone.inputs():
+                self.zoneindex.setdefault(entity, []).append(zone)
+        shared = {self.CEXTEMPN: "cext", self.FHIGHN: "fhigh", self.SOLARN: "solar", self.AWAYN: "away"}
+        for entity, field in shared.items():
+            self.zoneindex[entity] = list(self.zones)
+            for zone in self.zones:
+                zone.fields[entity] = field
+
+        # how hard we try not to flip flop, a single hysteresis value or one per user value
+        band = self.args.get("hysteresis", 0.2)
+        if isinstance(band, dict):
+            self.BAND = dict((k.upper(), float(v)) for k, v in band.items())
+        else:
+            self.BAND = dict((key, float(band)) for key, arg, label in USERVALUES)
+        self.DWELL = float(self.args.get("dwell", 300))
+        self.RULEDWELL = dict((k, float(v)) for k, v in (self.args.get("rule_dwell") or {}).items())
+        self.DEVICEDWELL = float(self.args.get("device_dwell", 180))
+
+        # how gently we treat slow devices
+        rate = self.args.get("rate_limit", 5)
+        if isinstance(rate, dict):
+            self.RATES = dict((k, float(v)) for k, v in rate.items())
+        else:
+            self.RATE = float(rate)
+        self.RETRIES = int(self.args.get("retries", 5))
+        self.BACKOFF = float(self.args.get("retry_backoff", 2))
+
+        # how much power there is to spare and what each device needs from it
+        power = self.args.get("power") or {}
+        self.POWER = bool(power)
+        self.BUDGET = float(power.get("budget", 0))
+        self.POWERSENSOR = power.get("sensor")
+        self.STAGGER = float(power.get("stagger", 30))
+        devices = power.get("devices") or {}
+        self.DRAW = dict((unit, float(d.get("draw", 0))) for unit, d in devices.items())
+        self.PRIORITY = dict((unit, (float(d.get("priority", 10)), i)) for i, (unit, d) in enumerate(devices.items()))
+        self.unitzone = dict((unit, z) for z in self.zones for unit in z.AIRCON + z.HEATER)
+        self.waiting = set()
+        self.laststart = None
+        self.shed = None
+
+        # the parts of the day, with a timer at each end so we're told rather than checking the time
+        self.WINDOWS = {}
+        for name, (start, end) in WINDOWS.items():
+            conf = (self.args.get("windows") or {}).get(name) or {}
+            self.WINDOWS[name] = (timeofday(conf.get("start", start)), timeofday(conf.get("end", end)))
+        now = self.now()
+        self.window = set(name for name, (start, end) in self.WINDOWS.items() if inwindow(start, end, now.time()))
+        for name, (start, end) in self.WINDOWS.items():
+            self.run_daily(self.boundary, start, window=name, inside=True)
+            self.run_daily(self.boundary, end, window=name, inside=False)
+
+        # where the counters go
+        self.METRICSENSOR = self.args.get("metrics_sensor", "sensor.climatecontrol_metrics")
+        self.METRICSFILE = self.args.get("metrics_file")
+        self.telemetry = None
+        self.unrecorded = []
+        if self.args.get("telemetry_file"):
+            try:
+                self.telemetry = Telemetry(self.args["telemetry_file"], int(self.args.get("telemetry_size", 262144)),
+                                           [zone.name for zone in self.zones])
+            except (OSError, ValueError) as e:
+                self.log("Telemetry not kept: " + str(e), level="WARNING")
+
+        # keep a local copy of everything we read, so an evaluation doesn't go back to HA
+        states = self.get_state() or {}
+        self.metrics.gets += 1
+        self.watch([self.CEXTEMPN, self.FHIGHN, self.SOLARN, self.AWAYN, self.MANUAL]
+                   + [x for z in self.zones for x in z.inputs()], states)
+        self.track(states)
+
+        # starting more devices or shedding one as the spare power changes
+        if self.POWERSENSOR:
+            self.watch([self.POWERSENSOR], states)
+            self.listen_state(self.powerer, self.POWERSENSOR)
+
+        # keep count of the open doors and windows as they change rather than looking each time
+        self.DOORPAUSE = float(self.args.get("door_pause", 0)) * 60
+        self.paused = False
+        self.opendoors = set(door for door in self.DOOR if (states.get(door) or {}).get("state") == 'on')
+        for door in self.DOOR:
+            self.listen_state(self.doorer, door)
+        if self.opendoors and self.DOORPAUSE > 0:
+            self.later(("doors",), self.DOORPAUSE, self.doorpause)
+
+        # if anything the decision reads changes, adjust the climate control
+        self.insidesensors = set(sensor for z in self.zones for sensor in z.SENSORS)
+        self.asked = {}
+        for entity in self.insidesensors | set(shared):
+            self.listen_state(self.main, entity)
         # if set to manual, then ignore everything
         self.listen_state(self.ignorer, self.MANUAL)
 
         # if the user temperature settings change update them on the fly
-        self.listen_state(self.setvals, self.EXTHIGHN)
-        self.listen_state(self.setvals, self.INTHIGHN)
-        self.listen_state(self.setvals, self.OPTHIGHN)
-        self.listen_state(self.setvals, self.OPTLOWN)
-        self.listen_state(self.setvals, self.INTLOWN)
-        self.listen_state(self.setvals, self.EXTLOWN)
+        for entity in set(getattr(z, key + "N") for z in self.zones for key, arg, label in USERVALUES):
+            self.listen_state(self.setvals, entity)
 
         # set the orignal values
         self.load()
 
+        # pick up where we left off, then take control straight away rather than at the next event
+        self.STATEFILE = self.args.get("state_file")
+        self.dirty = False
+        if self.STATEFILE:
+            self.restore()
+            self.run_every(self.checkpoint, "now", int(self.args.get("state_interval", 60)))
+        # the inside temperatures as they stand, from HA or what we restored
+        now = self.now()
+        for zone in self.zones:
+            for sensor in zone.SENSORS:
+                zone.inside.update(sensor, self.cache.get(sensor), now)
+            self.settle(zone)
+        self.run_in(self.takeover, 0)
+
+        # publish the counters every so often
+        self.run_every(self.publish, "now", int(self.args.get("metrics_interval", 300)))
+
+        # look ahead with each zone's thermal model, if there is one
+        pre = self.args.get("precondition") or {}
+        self.PREBY = {}
+        if pre.get("model"):
+            try:
+                with open(pre["model"]) as f:
+                    models = json.load(f)
+            except (OSError, ValueError) as e:
+                self.log("Thermal model not used: " + str(e), level="WARNING")
+                models = {}
+            for zone in self.zones:
+                if zone.name in models:
+                    zone.model = ThermalModel(**models[zone.name])
+            self.PREBY = {"cool": timeofday(pre.get("cool_by", "17:00")), "heat": timeofday(pre.get("heat_by", "07:00"))}
+            self.HORIZON = float(pre.get("horizon", 8))
+            self.PREEVERY = int(pre.get("every", 600))
+            if any(zone.model for zone in self.zones):
+                self.run_every(self.predict, "now", self.PREEVERY)
+
+
+    def terminate(self):
+        """ this saves the state and closes the telemetry as AppDaemon stops the app
+        """
+        if self.STATEFILE:
+            self.save()
+        if self.telemetry:
+            self.telemetry.close()
+
 
     def ignorer(self, entity, attribute, old, new, kwargs):
         """ this watches the ignore flag, to show we are in 'manual mode'
             
         """
+        # ahead of cacher, which may not have run yet, so takecontrol sees the flag as it is now
+        self.cache[entity] = new
         if new == 'on':
             self.log("Manual Mode: ignoring temperature controls")
             self.setrule("Manual")
-            # turn everything off so that it can be manually set
-            for ac in self.AIRCON:
-                self.toff(ac, "AC")
-            for fan in self.FAN:
-                self.toff(fan, "FAN")
-            for heater in self.HEATER:
-                self.toff(heater, "HEATER")
+            # turn everything off so that it can be manually set, now rather than after the dwell
+            self.holding += 1
+            try:
+                for zone in self.zones:
+                    zone.rule = None
+                    self.apply({"AC": OFF, "FAN": OFF, "HEATER": OFF}, zone, force=True)
+            finally:
+                self.holding -= 1
+            self.flush()
         else:
             self.log("Controlled Mode: managing temperature controls")
             self.setrule("Initialising")
-            # toggle the away flag so that it rechecks and takes over the climate control
-            if self.get_state(self.AWAYN) == 'on':
-                self.turn_off(self.AWAYN)
-                self.turn_on(self.AWAYN)
-            else:
-                self.turn_on(self.AWAYN)
-                self.turn_off(self.AWAYN)
+            self.takecontrol()
+
+
+    def takeover(self, kwargs):
+        """ this is the timer callback for taking control, see takecontrol
+        """
+        self.takecontrol()
+
+
+    def takecontrol(self):
+        """ this looks at every zone once and brings every device into line with it
+            callbacks call this rather than takeover, which the async class makes a coroutine
+        """
+        if self.cache.get(self.MANUAL) == 'on':
+            return
+        self.holding += 1
+        try:
+            self.evaluate("temp", self.zones)
+        finally:
+            self.holding -= 1
+        self.flush()
 
 
 
     # run the app
     def main(self, entity, attribute, old, new, kwargs):
         """ this does all the checking and controls the climate
-            
+            only the zones the entity feeds are looked at, and their calls go out together
         """
         
-        if self.get_state(self.MANUAL) != 'on':
-        
-            self.log("entity change: " + entity + " old: " + old + " new: " + new)
-
-            # if the house goes to everyone away - turn everything off now
-            if entity == self.AWAYN:
-                if new == "on":
-                    self.setrule("All Away - Off")
-                    for ac in self.AIRCON:
-                        self.toff(ac, "AC")
-                    for fan in self.FAN:
-                        self.toff(fan, "FAN")
-                    for heater in self.HEATER:
-                        self.toff(heater, "HEATER")
-            # when the internal temperature changes
-            elif entity == self.CINTEMPN:
-                if float(new) > float(self.EXTHIGH):
-                    # never let it get this hot ever # ensure the house never gets above the set user external high
-                    self.setrule("Above Ext High - Cooling")
-                    for ac in self.AIRCON:
-                        self.ton(ac, "AC", mode="cool", temp=self.INTHIGH, spd="High")
-                    for fan in self.FAN:
-                        self.ton(fan, "FAN")
-                    for heater in self.HEATER:
-                        self.toff(heater, "HEATER")
-                elif float(new) < float(self.EXTLOW):
-                    #never let it get this cold ever
-                    self.setrule("Below Ext Low - Heating")
-                    for ac in self.AIRCON:
-                        self.ton(ac, "AC", mode="heat", temp=self.INTLOW, spd="High")
-                    for fan in self.FAN:
-                        self.toff(fan, "FAN")
-                    for heater in self.HEATER:
-                        self.ton(heater, "HEATER", mode="heat", temp=self.INTLOW)
-                elif float(new) > float(self.OPTLOW) and float(new) < float(self.INTHIGH):
-                    #self.log("goldilocks")
-                    self.setrule("Goldilocks")
-                    # this is in the goldilocks range, mostly aim to control
-                    if float(self.get_state(self.CEXTEMPN)) > float(self.OPTHIGH):
-                        # if the outside temperature is higher than the optimal high (but we are in the goldilocks range)
-                        self.setrule("Goldilocks (Hot out) - AC Fans")
-                        for ac in self.AIRCON:
-                            #self.ton(ac, "AC", mode="fan_only")
-                            self.toff(ac, "AC")
-                        for fan in self.FAN:
-                            self.ton(fan, "FAN")
-                        for heater in self.HEATER:
-                            self.toff(heater, "HEATER")
-                    else:
-                        # if the outside temp is lower than optimal but the forecast is higher (but we are in the goldilocks range)
-                        if float(self.get_state(self.FHIGHN)) > float(self.OPTHIGH):
-                            self.setrule("Goldilocks (Hot Soon) - Fans")
-                            for ac in self.AIRCON:
-                                self.toff(ac, "AC")
-                            for fan in self.FAN:
-                                self.ton(fan, "FAN")
-                            for heater in self.HEATER:
-                                self.toff(heater, "HEATER")
-                        else:
-                            # everything is optimal - everything off
-                            self.setrule("Goldilocks")
-                            for ac in self.AIRCON:
-                                self.toff(ac, "AC")
-                            for fan in self.FAN:
-                                self.toff(fan, "FAN")
-                            for heater in self.HEATER:
-                                self.toff(heater, "HEATER")
-                else:
-                    # this is in the outer ranges, need to check more complexity
-                    # is the house empty
-                    if self.get_state(self.AWAYN) == 'on': 
-                        # then in this range just turn off
-                        self.setrule("All Away - Complex Off")
-                        for ac in self.AIRCON:
-                            self.toff(ac, "AC")
-                        for fan in self.FAN:
-                            self.toff(fan, "FAN")
-                        for heater in self.HEATER:
-                            self.toff(heater, "HEATER")
-                    else:
-                        # people are home, so lets work out how to bring it back to optimal
-                        # if after 2pm, ignore the forecast and just work on the inside temp
-                        if int(datetime.datetime.now().hour) >= 14:
-                            if self.get_state(self.SOLARN) == 'on':
-                                # solar is available - heat further
-                                if float(self.get_state(self.CINTEMPN)) < float(self.OPTLOW):
-                                    # internal temp is lower than optimal
-                                    self.setrule("Solar - Heating to Optimal")
-                                    for ac in self.AIRCON:
-                                        self.ton(ac, "AC", mode="heat", temp=self.OPTHIGH, spd="Low")
-                                    for fan in self.FAN:
-                                        self.toff(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.ton(heater, "HEATER", mode="heat", temp=self.OPTHIGH)
-                                elif float(self.get_state(self.CINTEMPN)) > float(self.OPTHIGH):
-                                    self.setrule("Cooling to Optimum Low (>2pm)")
-                                    for ac in self.AIRCON:
-                                        self.ton(ac, "AC", mode="cool", temp=self.OPTLOW, spd="Low")
-                                    for fan in self.FAN:
-                                        self.ton(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.toff(heater, "HEATER")
-                                else:
-                                    # internal temp is fine, keep the little heaters on
-                                    self.setrule("Solar - Small Heaters to Optimal")
-                                    for ac in self.AIRCON:
-                                        self.toff(ac, "AC")
-                                    for fan in self.FAN:
-                                        self.toff(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.ton(heater, "HEATER", mode="heat", temp=self.OPTLOW)
-                            else:
-                                # solar is not available - some heating
-                                if float(self.get_state(self.CINTEMPN)) < float(self.INTLOW):
-                                    # internal temp is lower than optimal
-                                    self.setrule("Heating to Internal Low")
-                                    for ac in self.AIRCON:
-                                        self.ton(ac, "AC", mode="heat", temp=self.INTLOW, spd="Mid")
-                                    for fan in self.FAN:
-                                        self.toff(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.ton(heater, "HEATER", mode="heat", temp=self.INTLOW)
-                                elif float(self.get_state(self.CINTEMPN)) > float(self.INTHIGH):
-                                    self.setrule("Cooling to Internal High (>2pm)")
-                                    for ac in self.AIRCON:
-                                        self.ton(ac, "AC", mode="cool", temp=self.INTHIGH, spd="Low")
-                                    for fan in self.FAN:
-                                        self.ton(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.toff(heater, "HEATER")
-                                else:
-                                    # internal temp is ok
-                                    self.setrule("Internal Good - All Off")
-                                    for ac in self.AIRCON:
-                                        self.toff(ac, "AC")
-                                    for fan in self.FAN:
-                                        self.toff(fan, "FAN")
-                                    for heater in self.HEATER:
-                                        self.toff(heater, "HEATER")
-                        else:
-                            #if early in the day and the forecast is going to be high
-                            if float(self.get_state(self.FHIGHN)) >= float(self.INTHIGH):
-                                # if the forecast is for high today, then we are cooling
-                                # see if we have solar
-                                if self.get_state(self.SOLARN) == 'on':
-                                    # solar is available - cool further
-                                    if float(self.get_state(self.CINTEMPN)) > float(self.OPTHIGH):
-                                        # internal temp is higher than optimal
-                                        self.setrule("Solar - Cooling to Optimal")
-                                        for ac in self.AIRCON:
-                                            self.ton(ac, "AC", mode="cool", temp=self.OPTHIGH, spd="Low")
-                                        for fan in self.FAN:
-                                            self.ton(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.toff(heater, "HEATER")
-                                    else:
-                                        # internal temp is not high but
-                                        # external temp is high
-                                        #self.log("will be hot - solar")
-                                        if float(self.get_state(self.CEXTEMPN)) > float(self.OPTHIGH):
-                                            self.setrule("Solar - Fans (Forecast Hot)")
-                                            for ac in self.AIRCON:
-                                                self.toff(ac, "AC")
-                                                #self.ton(ac, "AC", mode="fan_only")
-                                            for fan in self.FAN:
-                                                self.ton(fan, "FAN")
-                                            for heater in self.HEATER:
-                                                self.toff(heater, "HEATER")
-                                        else:
-                                            # external temp is ok, let it naturally cool
-                                            self.setrule("Solar - Goldilocks")
-                                            for ac in self.AIRCON:
-                                                self.toff(ac, "AC")
-                                            for fan in self.FAN:
-                                                self.toff(fan, "FAN")
-                                            for heater in self.HEATER:
-                                                self.toff(heater, "HEATER")
-                                else:
-                                    # solar is not available - some cooling
-                                    if float(self.get_state(self.CINTEMPN)) > float(self.INTHIGH):
-                                        # internal temp is higher than optimal
-                                        self.setrule("Cooling to Internal High")
-                                        for ac in self.AIRCON:
-                                            self.ton(ac, "AC", mode="cool", temp=self.INTHIGH, spd="Mid")
-                                        for fan in self.FAN:
-                                            self.ton(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.toff(heater, "HEATER")
-                                    else:
-                                        if float(self.get_state(self.CINTEMPN)) > float(self.OPTLOW):
-                                            # internal temp is not high but
-                                            # external temp is high
-                                            #self.log("will be hot - no solar | ext:" + float(self.get_state(self.CEXTEMPN)) + " opth: " + float(self.OPTHIGH) )
-                                            if float(self.get_state(self.CEXTEMPN)) > float(self.OPTHIGH):
-                                                self.setrule("Fans (is hot out)")
-                                                for ac in self.AIRCON:
-                                                    self.toff(ac, "AC")
-                                                    #self.ton(ac, "AC", mode="fan_only")
-                                                for fan in self.FAN:
-                                                    self.ton(fan, "FAN")
-                                                for heater in self.HEATER:
-                                                    self.toff(heater, "HEATER")
-                                            else:
-                                                # external temp is ok, let it naturally cool
-                                                self.setrule("Goldilocks (No Solar, Warm out)")
-                                                for ac in self.AIRCON:
-                                                    self.toff(ac, "AC")
-                                                for fan in self.FAN:
-                                                    self.toff(fan, "FAN") 
-                                                for heater in self.HEATER:
-                                                    self.toff(heater, "HEATER")
-                                        else:
-                                            # external temp is ok, let it naturally cool
-                                            self.setrule("Goldilocks (No Solar)")
-                                            for ac in self.AIRCON:
-                                                self.toff(ac, "AC")
-                                            for fan in self.FAN:
-                                                self.toff(fan, "FAN") 
-                                            for heater in self.HEATER:
-                                                self.toff(heater, "HEATER")
-
-                            elif float(self.get_state(self.FHIGHN)) <= float(self.OPTLOW):
-                                # if the forecast is for low today, then we are heating
-                                # see if we have solar
-                                if self.get_state(self.SOLARN) == 'on':
-                                    # solar is available - heat further
-                                    if float(self.get_state(self.CINTEMPN)) < float(self.OPTLOW):
-                                        # internal temp is higher than optimal
-                                        self.setrule("(F) Solar - Heating to Optimal")
-                                        for ac in self.AIRCON:
-                                            self.ton(ac, "AC", mode="heat", temp=self.OPTLOW, spd="Low")
-                                        for fan in self.FAN:
-                                            self.toff(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.ton(heater, "HEATER", mode="heat", temp=self.OPTLOW)
-                                    else:
-                                        # internal temp is fine, keep the little heaters on
-                                        self.setrule("(F) Solar - Small Heaters to Optimal")
-                                        for ac in self.AIRCON:
-                                            self.toff(ac, "AC")
-                                        for fan in self.FAN:
-                                            self.toff(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.ton(heater, "HEATER", mode="heat", temp=self.OPTLOW)
-                                else:
-                                    # solar is not available - some heating
-                                    if float(self.get_state(self.CINTEMPN)) < float(self.INTLOW):
-                                        # internal temp is higher than optimal
-                                        self.setrule("(F) Heating to Internal Low")
-                                        for ac in self.AIRCON:
-                                            self.ton(ac, "AC", mode="heat", temp=self.INTLOW, spd="Mid")
-                                        for fan in self.FAN:
-                                            self.toff(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.ton(heater, "HEATER", mode="heat", temp=self.INTLOW)
-                                    else:
-                                        # internal temp is ok
-                                        # external temp is ok, let it naturally cool
-                                        self.setrule("(F) Small Heaters to Internal Low")
-                                        for ac in self.AIRCON:
-                                            self.toff(ac, "AC")
-                                        for fan in self.FAN:
-                                            self.toff(fan, "FAN")
-                                        for heater in self.HEATER:
-                                            self.ton(heater, "HEATER", mode="heat", temp=self.INTLOW)
-                            else:
-                                # if the forecast is in the middle then we do nothing? and let the house cool or heat naturally?
-                                pass
-
-            #self.log(logger)
+        # the cache callback for this entity may not have run yet
+        self.cache[entity] = new
+        if entity in self.insidesensors:
+            # only the zones whose inside temperature has really moved
+            now = self.now()
+            self.refresh(entity, now)
+            zones = [z for z in self.zoneindex.get(entity, ()) if entity in z.SENSORS and z.inside.update(entity, new, now)]
+            for zone in self.zoneindex.get(entity, ()):
+                self.settle(zone)
+            if not zones:
+                self.metrics.filtered += 1
+                return
+            self.react(entity, "temp", old, new, zones)
+        else:
+            if entity == self.AWAYN and new == 'on':
+                # nobody to get the house ready for, until the model next looks
+                for zone in self.zones:
+                    zone.pre = None
+            self.react(entity, "away" if entity == self.AWAYN else "temp", old, new)
+
+
+    def refresh(self, entity, now):
+        """ this asks HA when the other sensors fused with entity last reported, if we haven't heard
+            from them for a while, as a steady reading sends no state change but isn't stale
+        """
+        quiet = self.quiet(entity, now)
+        if quiet:
+            tz = self.datetime(aware=True).tzinfo
+        for zone, sensor in quiet:
+            self.metrics.gets += 1
+            self.heard(zone, sensor, self.get_state(sensor, attribute="all"), now, tz)
+
+
+    def quiet(self, entity, now):
+        """ this lists the sensors fused with entity we should ask HA about, not more often than ASKEVERY
+        """
+        out = []
+        for zone in self.zoneindex.get(entity, ()):
+            for sensor in zone.inside.lapsed(now):
+                # entity itself has just been heard from
+                if sensor != entity and (sensor not in self.asked or (now - self.asked[sensor]).total_seconds() >= self.ASKEVERY):
+                    self.asked[sensor] = now
+                    out.append((zone, sensor))
+        return out
+
+
+    def heard(self, zone, sensor, state, now, tz=None):
+        """ this passes on when a sensor last reported, by HA's last_reported (or last_updated)
+            without either, a sensor that's still available counts as reporting now
+            HA gives the time in UTC, it's moved to tz, AppDaemon's time zone, to compare with now
+        """
+        state = state or {}
+        when = state.get("last_reported") or state.get("last_updated")
+        if when:
+            when = self.convert_utc(when) if isinstance(when, str) else when
+            if when.tzinfo is not None:
+                when = when.astimezone(tz).replace(tzinfo=None)
+        elif state.get("state") not in (None, "unavailable", "unknown"):
+            when = now
+        if when:
+            zone.inside.heard(sensor, when)
+
+
+    def react(self, entity, trigger, old, new, zones=None):
+        """ this evaluates the zones whose last decision depended on entity, the rest can't change
+        """
+        if self.cache.get(self.MANUAL) == 'on':
+            return
+        zones = [z for z in (self.zoneindex.get(entity, ()) if zones is None else zones) if z.depends(entity)]
+        if not zones:
+            self.metrics.skipped += 1
+            return
+
+        self.log("entity change: " + entity + " old: " + str(old) + " new: " + str(new))
+        self.holding += 1
+        try:
+            self.evaluate(trigger, zones)
+        finally:
+            self.holding -= 1
+        self.flush()
+
+
+    def evaluate(self, trigger, zones):
+        """ this times and counts one evaluation of some zones, until flush has sent its calls
+        """
+        self.mark = self.metrics.start()
+        shared = self.shared(trigger)
+        for zone in zones:
+            self.decideandapply(zone, shared)
+
+
+    def decideandapply(self, zone, shared):
+        """ this makes one decision for a zone and applies it, unless the current rule hasn't
+            been in force for its dwell time yet, in which case we look again when it has
+        """
+        snap = self.snapshot(zone, shared)
+        if snap.trigger == "temp" and snap.cin is None:
+            # unavailable or not a number, wait for a real reading
+            return
+        if zone.th is None:
+            # no valid user values yet, nothing to decide with
+            return
+        rule, plan, zone.bits, used = decide(snap, zone.th, zone.bits, self.BAND)
+        zone.deps = reads(used)
+        if rule is None:
+            self.record(zone, snap, None)
+            return
+
+        now = self.now()
+        if rule != zone.rule and zone.rule is not None and snap.trigger != "away":
+            # leaving the house is never held back
+            held = self.RULEDWELL.get(zone.rule, self.DWELL) - (now - zone.rulesince).total_seconds()
+            if held > 0:
+                # the rule we'd change to may depend on anything, so look at every change
+                zone.deps = None
+                self.later(("rule", zone.name), held, self.recheck, zone=zone.name)
+                self.record(zone, snap, rule, held=True)
+                return
 
+        if rule != zone.rule:
+            zone.rule = rule
+            zone.rulesince = now
+            self.dirty = True
+            self.metrics.ruled(zone.name, rule, now)
+        self.setrule(rule, zone)
+        self.apply(plan, zone)
+        self.record(zone, snap, rule)
+
+
+    def record(self, zone, snap, rule, held=False):
+        """ this keeps one evaluation for the telemetry, if there is any, until its calls are sent
+        """
+        if self.telemetry:
+            self.unrecorded.append((self.now(), zone, snap, rule, held))
+
+
+    def finished(self, sentto):
+        """ this ends the evaluation whose calls have just been sent, each zone is recorded
+            with the service calls that went to its devices, sentto has the count for each device
+        """
+        if self.mark is not None:
+            self.metrics.finish(self.mark)
+            self.mark = None
+        for now, zone, snap, rule, held in self.unrecorded:
+            calls = sum(sentto.get(unit, 0) for unit in zone.AIRCON + zone.FAN + zone.HEATER)
+            self.telemetry.record(now, zone.name, snap, rule, held, calls)
+        self.unrecorded = []
+
+
+    def boundary(self, kwargs):
+        """ this is called as a window starts or ends, so the rules see it straight away
+        """
+        if kwargs["inside"]:
+            self.window.add(kwargs["window"])
+        else:
+            self.window.discard(kwargs["window"])
+        self.log(kwargs["window"] + (" started" if kwargs["inside"] else " ended"))
+        if self.cache.get(self.MANUAL) == 'on':
+            return
+        self.holding += 1
+        try:
+            self.evaluate("temp", self.zones)
+        finally:
+            self.holding -= 1
+        self.flush()
+
+
+    def settle(self, zone):
+        """ this keeps a smoothed inside temperature moving toward a reading that holds steady,
+            as there's no new reading to move it
+        """
+        key = ("smooth", zone.name)
+        if zone.inside.smoothing > 0 and zone.inside.settling() and key not in self.timers:
+            self.later(key, max(zone.inside.smoothing / 5, 10), self.smoother, zone=zone.name)
+
+
+    def smoother(self, kwargs):
+        """ this moves a zone's smoothed inside temperature on, and decides again if it has moved a step
+        """
+        self.timers.pop(("smooth", kwargs["zone"]), None)
+        zone = next(z for z in self.zones if z.name == kwargs["zone"])
+        if zone.inside.advance(self.now()) and self.cache.get(self.MANUAL) != 'on' and zone.depends(zone.SENSORS[0]):
+            self.evaluate("temp", [zone])
+            self.flush()
+        self.settle(zone)
+
+
+    def recheck(self, kwargs):
+        """ this looks again once a held rule's dwell is up
+        """
+        self.timers.pop(("rule", kwargs["zone"]), None)
+        if self.cache.get(self.MANUAL) != 'on':
+            self.evaluate("temp", [z for z in self.zones if z.name == kwargs["zone"]])
+            self.flush()
+
+
+    def now(self):
+        """ this is the time according to AppDaemon, so time travel and the simulator work
+        """
+        return self.datetime()
+
+
+    def later(self, key, delay, callback, **kwargs):
+        """ this runs a callback after delay seconds, replacing any earlier timer for the same key
+        """
+        if key in self.timers:
+            self.cancel_timer(self.timers[key])
+        self.timers[key] = self.run_in(callback, int(delay) + 1, **kwargs)
+
+
+    def watch(self, entities, states):
+        """ this fills the cache from the states read at start up and keeps it up to date from state changes
+        """
+        for entity in entities:
+            if entity not in self.cache:
+                self.cache[entity] = (states.get(entity) or {}).get("state")
+                self.listen_state(self.cacher, entity)
+
+
+    def cacher(self, entity, attribute, old, new, kwargs):
+        """ this keeps the local copy of an entity's state current
+        """
+        self.cache[entity] = new
+
+
+    def shared(self, trigger):
+        """ this reads the inputs every zone shares, once for all of them
+        """
+        c = self.cache
+        return (trigger, tofloat(c.get(self.CEXTEMPN)), tofloat(c.get(self.FHIGHN)),
+                c.get(self.SOLARN) == 'on', c.get(self.AWAYN) == 'on', "afternoon" in self.window)
+
+
+    def snapshot(self, zone, shared):
+        """ this takes a frozen copy of a zone's inputs so one evaluation sees one moment in time
+        """
+        trigger, cext, fhigh, solar, away, afternoon = shared
+        return Snapshot(trigger, zone.inside.value, cext, fhigh, solar, away, afternoon, zone.pre == "cool", zone.pre == "heat")
+
+
+    def predict(self, kwargs):
+        """ this asks each zone's model whether waiting any longer would leave the house too hot or
+            cold by the time it needs to be comfortable, and if so starts cooling or heating now
+            starting as late as that allows keeps the devices running the least
+        """
+        if self.cache.get(self.MANUAL) == 'on':
+            return
+        now = self.now()
+        c = self.cache
+        away = c.get(self.AWAYN) == 'on'
+        # the day's forecast stands in for the outside temperature until the deadline
+        outside = {"cool": tofloat(c.get(self.FHIGHN)), "heat": tofloat(c.get(self.FLOWN))}
+        free = {"solar": 1.0 if c.get(self.SOLARN) == 'on' else 0.0}
+        changed = []
+        for zone in self.zones:
+            pre = None
+            inside = zone.inside.value
+            if zone.model and zone.th and inside is not None and not away:
+                for mode, target, running in (("cool", zone.th["INTHIGH"], {"cool": len(zone.AIRCON)}),
+                                              ("heat", zone.th["INTLOW"], {"heat": len(zone.AIRCON), "heater": len(zone.HEATER)})):
+                    by = datetime.datetime.combine(now.date(), self.PREBY[mode])
+                    if by <= now:
+                        by += datetime.timedelta(days=1)
+                    hours = (by - now).total_seconds() / 3600
+                    if hours > self.HORIZON or outside[mode] is None or not any(running.values()):
+                        continue
+                    running = dict(running, **free)
+                    start = zone.model.start(inside, outside[mode], hours, target, running, free)
+                    if start is not None and start * 3600 < self.PREEVERY:
+                        pre = mode
+                        break
+            if pre != zone.pre:
+                self.log(zone.name + (" pre-" + pre + "ing" if pre else " no longer preconditioning"))
+                zone.pre = pre
+                changed.append(zone)
+        if changed:
+            self.holding += 1
+            try:
+                self.evaluate("temp", changed)
+            finally:
+                self.holding -= 1
+            self.flush()
+
+
+    def apply(self, plan, zone, force=False):
+        """ this will send each of the zone's device types the action the decision table chose for it
+            the calls are held and sent together so devices doing the same thing share one call
+        """
+        self.holding += 1
+        try:
+            for aftype, units in (("AC", zone.AIRCON), ("FAN", zone.FAN), ("HEATER", zone.HEATER)):
+                action = plan[aftype]
+                for unit in units:
+                    if action[0] == "off":
+                        self.toff(unit, aftype, force)
+                    else:
+                        self.ton(unit, aftype, mode=action[1], temp=action[2], spd=action[3], force=force)
+        finally:
+            self.holding -= 1
+        self.flush()
 
 
     def setvals(self, entity, attribute, old, new, kwargs):
         """ this sets the user values that are used to control the climate
+            every zone's new values are checked before any of them is swapped in
         """
-
-        if entity == self.EXTHIGHN:
-            self.EXTHIGH = new
-            self.log("Change Maximum External High to " + new)
-        elif entity == self.INTHIGHN:
-            self.INTHIGH = new
-            self.log("Change Internal High to " + new)
-        elif entity == self.OPTHIGHN:
-            self.OPTHIGH = new
-            self.log("Change Optimal High to " + new)
-        elif entity == self.OPTLOWN:
-            self.OPTLOW = new
-            self.log("Change Optimal Low to " + new)
-        elif entity == self.INTLOWN:
-            self.INTLOW = new
-            self.log("Change Internal Low to " + new)
-        elif entity == self.EXTLOWN:
-            self.EXTLOW = new
-            self.log("Change Maximum Low to " + new)
+        changed = None
+        swaps = []
+        try:
+            for zone in self.zoneindex.get(entity, ()):
+                for key, arg, label in USERVALUES:
+                    if getattr(zone, key + "N") == entity:
+                        changed = label
+                        values = dict((k, self.cache.get(getattr(zone, k + "N"))) for k in USERKEYS)
+                        values[key] = new
+                        swaps.append((zone, Thresholds(**values) if zone.th is None else zone.th.replace(**{key: new})))
+        except ValueError as e:
+            self.log("Rejected " + str(changed) + " of " + str(new) + ": " + str(e), level="WARNING")
+            return
+        if changed:
+            for zone, th in swaps:
+                zone.th = th
+            self.dirty = True
+            self.log("Change " + changed + " to " + str(new))
+            self.react(entity, "temp", old, new)
         else:
             self.log("Unknown User Value Change Requested")
 
@@ -469,124 +742,592 @@ class Manage_Climate(hass.Hass):
     def load(self):
         """ this sets the original user values that are used to control the climate
         """
-        self.EXTHIGH = self.get_state(self.EXTHIGHN)
-        self.INTHIGH = self.get_state(self.INTHIGHN)
-        self.OPTHIGH = self.get_state(self.OPTHIGHN)
-        self.OPTLOW = self.get_state(self.OPTLOWN)
-        self.INTLOW = self.get_state(self.INTLOWN)
-        self.EXTLOW = self.get_state(self.EXTLOWN)
+        for zone in self.zones:
+            try:
+                zone.th = Thresholds(**dict((key, self.cache.get(getattr(zone, key + "N"))) for key in USERKEYS))
+            except ValueError as e:
+                self.log("User Values for " + zone.name + " not used: " + str(e), level="WARNING")
         self.log("Set all original User Values")
 
 
-    def setrule(self, val):
+    def setrule(self, val, zone=None):
         """ this will set the rule value in the front end so less logging is req
+            without a zone it goes to every zone, only if it has changed
         """
-        self.log(self.ACRULE + " " + val)
-        self.set_textvalue(self.ACRULE,val)
+        for z in ([zone] if zone else self.zones):
+            if z.published == val or z.ACRULE is None:
+                continue
+            z.published = val
+            self.log(z.ACRULE + " " + val)
+            self.set_textvalue(z.ACRULE, val)
     
-    def toff(self, unit, aftype):
+    def toff(self, unit, aftype, force=False):
         """ this will turn off an ac or a fan if it isn't already off
         """
-
-        if self.get_state(unit) != 'off':
-            if aftype == "AC":
-                self.call_service("climate/turn_off", entity_id=unit)
-                #self.log("turning " + unit + " off")
-            elif aftype == "FAN":
-                self.call_service("fan/turn_off", entity_id=unit)
-                #self.log("turning " + unit + " off")
-            elif aftype == "HEATER":
-                self.call_service("climate/turn_off", entity_id=unit)
-                #self.log("turning " + unit + " off")
-            else:
-                self.log("unknown off call")
+        if aftype in ("AC", "FAN", "HEATER"):
+            self.desire(unit, {"state": "off"})
+            self.reconcile(unit, aftype, force)
         else:
-            #self.log("already off - not turning off " + unit)
-            pass
+            self.log("unknown off call")
 
     
-    def ton(self, unit, aftype, mode="fan_only", temp="0.0", spd="Low"):
+    def ton(self, unit, aftype, mode="fan_only", temp="0.0", spd="Low", force=False):
         """ this will turn on an ac or a fan if it isn't already on
         """
 
-        #don't run the small heaters during the night 9pm to 5am
-        hflag = False
-        if aftype == "HEATER":
-            #if between certain times - turn off rather than on
-            dnow = datetime.datetime.now()
-            #self.log(dnow.hour)
-            if dnow.hour >= 22 or dnow.hour <= 4:
-                self.toff(unit, "HEATER")
-                hflag = True
-
-        # if the flag hasn't been set in the above, then turn things on as normal
-        if hflag == False:
-
-            #self.log("call to turn on - " + unit + " type: " + aftype + " mode: " + mode + " temp: " + temp + " spd: " + spd )
-
-            if self.get_state(unit) == 'off':
-                if aftype == "AC":
-                        self.call_service("climate/set_hvac_mode", entity_id=unit, hvac_mode=mode)
-                        self.call_service("climate/set_fan_mode", entity_id=unit, fan_mode=spd)
-                        self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                        self.call_service("climate/turn_on", entity_id=unit)
-                        if mode != 'fan_only':
-                            self.lightwarn()
-                        self.log(unit + " on to " + mode)
-                elif aftype == "FAN":
-                    self.call_service("fan/increase_speed", entity_id=unit)
-                    #self.log(unit + " on")
-                elif aftype == "HEATER":
-                    self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                else:
-                    self.log("unknown on call - off")
-            #if already on, this will set from fan to cool/heat and from cool/heat back to fan
+        #don't run the small heaters during the night
+        if aftype == "HEATER" and "heater_curfew" in self.window:
+            self.toff(unit, "HEATER", force)
+            return
+
+        #nor heat or cool with the doors left open
+        if self.paused and (aftype == "HEATER" or (aftype == "AC" and mode != "fan_only")):
+            self.toff(unit, aftype, force)
+            return
+
+        if aftype == "AC":
+            want = {"state": mode, "fan_mode": spd, "temperature": tofloat(temp)}
+        elif aftype == "FAN":
+            want = {"state": "on"}
+        elif aftype == "HEATER":
+            want = {"state": "heat", "temperature": tofloat(temp)}
+        else:
+            self.log("unknown on call")
+            return
+        # checked against what the device can do, so it's never sent something it will refuse
+        want, problem = fit(aftype, want, self.actual.get(unit) or devicestate(None))
+        if problem:
+            self.metrics.rejected += 1
+            self.log(unit + " " + problem, level="WARNING")
+            # off at least, rather than left working against the rule
+            self.toff(unit, aftype, force)
+            return
+        self.desire(unit, want)
+        self.reconcile(unit, aftype, force)
+
+
+    def desire(self, unit, want):
+        """ this sets the state we want a device in, and notes there's something new to save if it's changed
+        """
+        if self.desired.get(unit) != want:
+            self.desired[unit] = want
+            self.dirty = True
+
+
+    def track(self, states):
+        """ this keeps the last known actual state of every device we control
+        """
+        for unit in self.AIRCON + self.FAN + self.HEATER:
+            self.actual[unit] = devicestate(states.get(unit))
+            self.listen_state(self.actualiser, unit, attribute="all")
+
+
+    def actualiser(self, entity, attribute, old, new, kwargs):
+        """ this updates a device's actual state when HA reports a change
+        """
+        self.actual[entity] = devicestate(new)
+
+
+    def reconcile(self, unit, aftype, force=False):
+        """ this sends only the service calls needed to move a device from its actual to its desired state
+            an ac or heater switched recently is left alone until its dwell is up, then looked at again
+        """
+        want = self.desired.get(unit)
+        have = self.actual.setdefault(unit, devicestate(None))
+        if want is None:
+            return
+        if want["state"] != have["state"] and aftype != "FAN":
+            now = self.now()
+            if not force and unit in self.changed:
+                held = self.DEVICEDWELL - (now - self.changed[unit]).total_seconds()
+                if held > 0:
+                    self.later(unit, held, self.redo, unit=unit, aftype=aftype)
+                    return
+            self.changed[unit] = now
+            self.dirty = True
+        calls = diff(aftype, want, have)
+        if not calls:
+            # it's already there, anything still waiting for it is stale
+            self.queue.pop(unit, None)
+            self.waiting.discard(unit)
+            self.metrics.queued = len(self.queue)
+            self.metrics.waiting = len(self.waiting)
+            return
+        if want["state"] != have["state"]:
+            self.log(unit + " to " + want["state"])
+        self.enqueue(unit, aftype)
+        if aftype == "AC" and any(params.get("hvac_mode", 'fan_only') != 'fan_only' for service, params in calls):
+            self.lightwarn()
+        self.flush()
+
+
+    def redo(self, kwargs):
+        """ this reconciles a device again once its dwell is up, against whatever is wanted by then
+        """
+        self.timers.pop(kwargs["unit"], None)
+        if self.cache.get(self.MANUAL) == 'on':
+            # the devices are the user's until we take control back
+            return
+        self.reconcile(kwargs["unit"], kwargs["aftype"])
+
+
+    def enqueue(self, unit, aftype):
+        """ this puts a device in the queue to be sent its desired state
+            a device already waiting keeps its place, it will just be sent the newer state
+        """
+        if unit in self.queue:
+            self.metrics.coalesced += 1
+            return
+        last = self.lastsent.get(unit)
+        due = self.now()
+        if last is not None:
+            due = max(due, last + datetime.timedelta(seconds=self.RATES.get(unit, self.RATE)))
+        self.queue[unit] = [aftype, 0, due]
+
+
+    def take(self, now):
+        """ this takes every device whose turn it is off the queue and works out its calls
+            as (stage, service, entity, params), stage keeps each device's own calls in order
+        """
+        commands, taken = [], {}
+        started = False
+        for unit in sorted(self.queue, key=lambda u: self.PRIORITY.get(u, (float("inf"), 0))):
+            aftype, attempts, due = entry = self.queue[unit]
+            if due > now:
+                continue
+            want = dict(self.desired[unit])
+            if self.POWER and drawing(aftype, want) and not drawing(aftype, self.actual.get(unit) or {}):
+                # one start at a time, and under a solar rule only if there's the power for it
+                if started or (self.laststart and now < self.laststart + datetime.timedelta(seconds=self.STAGGER)):
+                    entry[2] = (self.laststart or now) + datetime.timedelta(seconds=self.STAGGER)
+                    continue
+                if self.budgeted(unit) and self.DRAW.get(unit, 0) > self.headroom():
+                    if unit not in self.waiting:
+                        self.log(unit + " waiting for " + str(self.DRAW.get(unit, 0)) + "W")
+                    self.waiting.add(unit)
+                    continue
+                started = True
+                self.laststart = now
+            self.waiting.discard(unit)
+            del self.queue[unit]
+            taken[unit] = (aftype, attempts, want)
+            for stage, (service, params) in enumerate(diff(aftype, want, self.actual.setdefault(unit, devicestate(None)))):
+                commands.append((stage, service, unit, params))
+        return commands, taken
+
+
+    def done(self, taken, failed, now):
+        """ this records how the sends went, a device that failed goes back on the queue
+            to try again later, unless it's been tried too often
+        """
+        for unit, (aftype, attempts, want) in taken.items():
+            self.lastsent[unit] = now
+            if unit not in failed:
+                # assume it worked, HA will tell us if it didn't
+                self.actual[unit].update(want)
+            elif attempts >= self.RETRIES:
+                self.metrics.failures += 1
+                self.log("Gave up on " + unit + " after " + str(attempts + 1) + " tries", level="WARNING")
             else:
-                if aftype == "AC":
-                    #switch from fan_only to aircon
-                    if self.get_state(unit) == 'fan_only' and mode != 'fan_only':
-                        self.call_service("climate/set_hvac_mode", entity_id=unit, hvac_mode=mode)
-                        self.call_service("climate/set_fan_mode", entity_id=unit, fan_mode=spd)
-                        self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                        self.lightwarn()
-                        #self.log(unit + " on to " + mode + " at " + temp)
-                    #switch from aircon to fan_only 
-                    elif mode == 'fan_only' and self.get_state(unit) != 'fan_only':
-                        self.call_service("climate/set_hvac_mode", entity_id=unit, hvac_mode=mode)
-                        self.call_service("climate/set_fan_mode", entity_id=unit, fan_mode=spd)
-                        self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                        #self.log(unit + " on to " + mode)
-                    #switch temperatures when using aircon
-                    elif self.get_state(unit) != 'fan_only' and self.get_state(unit, attribute='temperature') != temp:
-                        self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                        #self.log(unit + " on to " + mode + " at " + temp)
-                elif aftype == "HEATER":
-                    self.call_service("climate/set_temperature", entity_id=unit, temperature=temp)
-                    #self.log(unit + " at " + temp)
-                elif aftype == "FAN":
-                    self.log(unit + " already on")
-                else:
-                    self.log("unknown on call - already on")
-        
-            
+                self.metrics.retries += 1
+                due = now + datetime.timedelta(seconds=self.BACKOFF * 2 ** attempts)
+                entry = self.queue.setdefault(unit, [aftype, attempts + 1, due])
+                entry[2] = max(entry[2], due)
+        self.metrics.queued = len(self.queue)
+        self.metrics.waiting = len(self.waiting)
+        # the devices waiting for power are looked at again when it changes, not on a timer
+        due = [entry[2] for unit, entry in self.queue.items() if unit not in self.waiting]
+        if due:
+            self.later(("queue",), (min(due) - now).total_seconds(), self.pump)
+
+
+    def budgeted(self, unit):
+        """ this says if a device is running under a solar rule, so it has to fit in the spare power
+        """
+        zone = self.unitzone.get(unit)
+        return zone is not None and zone.rule in SOLARRULES
+
+
+    def headroom(self):
+        """ this is the watts to spare, from the sensor if it's reading, otherwise the budget less what's running
+        """
+        surplus = tofloat(self.cache.get(self.POWERSENSOR)) if self.POWERSENSOR else None
+        if surplus is not None:
+            return surplus
+        return self.BUDGET - sum(draw for unit, draw in self.DRAW.items()
+                                 if drawing("HEATER" if unit in self.HEATER else "AC", self.actual.get(unit) or {}))
+
+
+    def powerer(self, entity, attribute, old, new, kwargs):
+        """ this starts whatever was waiting if there's now the power for it, or sheds the
+            least important device running on solar if we've started drawing from the grid
+        """
+        self.cache[entity] = new
+        surplus = tofloat(new)
+        now = self.now()
+        if self.shed is not None:
+            # the readings until the last one shed is sent off, and a while after, don't show it gone
+            unit, when = self.shed
+            sent = self.lastsent.get(unit)
+            if sent is not None and sent >= when and now >= sent + datetime.timedelta(seconds=self.STAGGER):
+                self.shed = None
+        if surplus is not None and surplus < 0 and self.shed is None and self.cache.get(self.MANUAL) != 'on':
+            # one switched on or off within its dwell is left alone, as for any other change
+            running = [unit for unit in self.DRAW if self.budgeted(unit) and unit not in self.queue
+                       and drawing("HEATER" if unit in self.HEATER else "AC", self.actual.get(unit) or {})
+                       and (unit not in self.changed or (now - self.changed[unit]).total_seconds() >= self.DEVICEDWELL)]
+            if running:
+                unit = max(running, key=lambda u: self.PRIORITY.get(u, (float("inf"), 0)))
+                self.log("Drawing " + str(-surplus) + "W from the grid: shedding " + unit)
+                self.shed = (unit, now)
+                # off for now, the next decision asks for it again and it waits for the power
+                self.desire(unit, {"state": "off"})
+                self.reconcile(unit, "HEATER" if unit in self.HEATER else "AC")
+        self.flush()
+
+
+    def pump(self, kwargs):
+        """ this sends whatever has come due on the queue
+        """
+        self.timers.pop(("queue",), None)
+        self.flush()
+
+
+    def flush(self):
+        """ this sends the queued devices whose turn it is, one call per service and parameters
+            with every entity that needs it
+        """
+        if self.holding > 0:
+            return
+        sentto = {}
+        if self.queue:
+            now = self.now()
+            commands, taken = self.take(now)
+            failed = set()
+            for stage, service, units, params in batch(commands):
+                units = [u for u in units if u not in failed]
+                if not units:
+                    continue
+                try:
+                    self.call_service(service, entity_id=units if len(units) > 1 else units[0], **params)
+                    self.metrics.sent(units)
+                    for unit in units:
+                        sentto[unit] = sentto.get(unit, 0) + 1
+                except Exception as e:
+                    self.log(service + " to " + ",".join(units) + " failed: " + str(e), level="WARNING")
+                    failed.update(units)
+            self.done(taken, failed, now)
+        # the evaluation's calls are sent, so that's the end of it
+        self.finished(sentto)
+
+
+    def publish(self, kwargs):
+        """ this puts the counters on an HA sensor and, if configured, in a Prometheus text file
+        """
+        now = self.now()
+        self.set_state(self.METRICSENSOR, state=self.metrics.evaluations, attributes=self.metrics.attributes(now))
+        if self.METRICSFILE:
+            # write then rename so a scrape never sees half a file
+            tmp = self.METRICSFILE + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.metrics.prometheus(now))
+            os.replace(tmp, self.METRICSFILE)
 
     
+    def checkpoint(self, kwargs):
+        """ this saves the state every so often, if anything has changed
+        """
+        if self.dirty:
+            self.save()
+
+
+    def save(self):
+        """ this writes what the controller knows to the state file, so a restart can carry on from it
+        """
+        def when(t):
+            return t.isoformat() if t else None
+        inputs = [self.CEXTEMPN, self.FHIGHN, self.SOLARN, self.AWAYN] + [x for z in self.zones for x in z.inputs()]
+        state = {"saved": when(self.now()),
+                 "zones": dict((z.name, {"rule": z.rule, "since": when(z.rulesince), "bits": z.bits,
+                                         "thresholds": dict((k, z.th[k]) for k in USERKEYS) if z.th else None})
+                               for z in self.zones),
+                 "desired": self.desired,
+                 "changed": dict((unit, when(t)) for unit, t in self.changed.items()),
+                 "inputs": dict((entity, self.cache.get(entity)) for entity in inputs)}
+        # write then rename so a crash never leaves half a file
+        tmp = self.STATEFILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.STATEFILE)
+        self.dirty = False
+
+
+    def restore(self):
+        """ this reads the state file from before a restart
+            HA's own values win, the saved inputs and user values only fill in what HA hasn't got yet
+        """
+        try:
+            with open(self.STATEFILE) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log("State file not used: " + str(e), level="WARNING")
+            return
+        def when(t):
+            return datetime.datetime.fromisoformat(t) if t else None
+        for entity, val in state.get("inputs", {}).items():
+            if self.cache.get(entity) in (None, "unavailable", "unknown"):
+                self.cache[entity] = val
+        for zone in self.zones:
+            saved = state.get("zones", {}).get(zone.name)
+            if not saved:
+                continue
+            zone.rule, zone.rulesince, zone.bits = saved["rule"], when(saved["since"]), saved["bits"]
+            if zone.th is None and saved.get("thresholds"):
+                try:
+                    zone.th = Thresholds(**saved["thresholds"])
+                except ValueError:
+                    pass
+        for unit, want in state.get("desired", {}).items():
+            self.desired[unit] = want
+        for unit, t in state.get("changed", {}).items():
+            self.changed[unit] = when(t)
+        self.log("Restored state saved at " + str(state.get("saved")))
+
+
     ## THIS WOULD NEED TO BE GENERICISED IF MADE AVAILABLE TO COMMUNITY
 
+    def doorer(self, entity, attribute, old, new, kwargs):
+        """ this keeps the open doors up to date, warns if one opens while heating or cooling,
+            starts the count down to pausing and resumes once they're all shut
+        """
+        if new == 'on':
+            if not self.opendoors and self.DOORPAUSE > 0:
+                self.later(("doors",), self.DOORPAUSE, self.doorpause)
+            self.opendoors.add(entity)
+            if self.running():
+                self.lightwarn()
+        else:
+            self.opendoors.discard(entity)
+            if not self.opendoors and self.paused:
+                self.log("Doors closed: resuming")
+                self.paused = False
+                self.takecontrol()
+
+
+    def doorpause(self, kwargs):
+        """ this pauses the ac and heaters once the doors have been open too long
+        """
+        self.timers.pop(("doors",), None)
+        if not self.opendoors or self.paused:
+            return
+        self.log("Doors open " + str(round(self.DOORPAUSE / 60)) + " minutes: pausing heating and cooling")
+        self.paused = True
+        self.takecontrol()
+
+
+    def running(self):
+        """ this says if any ac is heating or cooling or any heater is on
+        """
+        return (any(drawing("AC", self.actual.get(unit) or {}) for unit in self.AIRCON)
+                or any(drawing("HEATER", self.actual.get(unit) or {}) for unit in self.HEATER))
+
+
     def lightwarn(self):
         """ this will flash the front hall light if the doors are open when the aircon kicks in
         """
+        if self.opendoors:
+            for warnlight in self.WARNLIGHT:
+                self.desired[warnlight] = {"state": "on", "brightness": 100}
+                self.enqueue(warnlight, "LIGHT")
+            self.flush()
 
-        #if self.get_state("binary_sensor.fdoor_open") == 'on' or self.get_state("binary_sensor.bdoor_open") == 'on':
-        #    self.call_service("light/turn_on", entity_id="light.front_hall", brightness=100)
 
-        warn = 0
-        for door in self.DOOR:
-            if self.get_state(door) == 'on':
-                warn += 1
-           
-        if warn > 0:
-            for warnlight in self.WARNLIGHT:
-                self.call_service("light/turn_on", entity_id=warnlight, brightness=100)
-        
-            
\ No newline at end of file
+
+class Manage_Climate_Async(Manage_Climate):
+    """ the same climate control, but the callbacks run on AppDaemon's event loop and a
+        transition's service calls go out together instead of one after another
+        each device's own calls still go in order, stage by stage, so a transition
+        takes about one round trip per stage rather than one per call
+    """
+
+    LIMIT = 4 # most service calls waiting on HA at once
+    outbox = [] # rule text and timers waiting to be sent
+    clock = None # the time the running callback started
+
+    def initialize(self):
+        self.outbox = []
+        self.LIMIT = int(self.args.get("max_in_flight", 4))
+        # until a callback reads AppDaemon's clock, which windows we start in goes by the local one
+        self.clock = datetime.datetime.now()
+        Manage_Climate.initialize(self)
+
+
+    async def main(self, entity, attribute, old, new, kwargs):
+        self.clock = await self.datetime()
+        if entity in self.insidesensors:
+            quiet = self.quiet(entity, self.clock)
+            if quiet:
+                tz = (await self.datetime(aware=True)).tzinfo
+            for zone, sensor in quiet:
+                self.metrics.gets += 1
+                self.heard(zone, sensor, await self.get_state(sensor, attribute="all"), self.clock, tz)
+        Manage_Climate.main(self, entity, attribute, old, new, kwargs)
+        await self.drain()
+
+
+    async def ignorer(self, entity, attribute, old, new, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.ignorer(self, entity, attribute, old, new, kwargs)
+        await self.drain()
+
+
+    async def setvals(self, entity, attribute, old, new, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.setvals(self, entity, attribute, old, new, kwargs)
+        await self.drain()
+
+
+    async def boundary(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.boundary(self, kwargs)
+        await self.drain()
+
+
+    async def takeover(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.takeover(self, kwargs)
+        await self.drain()
+
+
+    async def doorer(self, entity, attribute, old, new, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.doorer(self, entity, attribute, old, new, kwargs)
+        await self.drain()
+
+
+    async def doorpause(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.doorpause(self, kwargs)
+        await self.drain()
+
+
+    async def powerer(self, entity, attribute, old, new, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.powerer(self, entity, attribute, old, new, kwargs)
+        await self.drain()
+
+
+    async def predict(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.predict(self, kwargs)
+        await self.drain()
+
+
+    async def smoother(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.smoother(self, kwargs)
+        await self.drain()
+
+
+    async def recheck(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.recheck(self, kwargs)
+        await self.drain()
+
+
+    async def redo(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.redo(self, kwargs)
+        await self.drain()
+
+
+    async def pump(self, kwargs):
+        self.clock = await self.datetime()
+        Manage_Climate.pump(self, kwargs)
+        await self.drain()
+
+
+    def now(self):
+        """ the time can't be awaited mid decision, so each callback reads it once up front
+        """
+        return self.clock
+
+
+    def refresh(self, entity, now):
+        """ main has already awaited the lookups
+        """
+        pass
+
+
+    def setrule(self, val, zone=None):
+        """ this holds the rule text until the callback can await it
+        """
+        for z in ([zone] if zone else self.zones):
+            if z.published == val or z.ACRULE is None:
+                continue
+            z.published = val
+            self.log(z.ACRULE + " " + val)
+            self.outbox.append((None, self.set_textvalue, (z.ACRULE, val), {}))
+
+
+    def later(self, key, delay, callback, **kwargs):
+        """ this holds a timer until the callback can await it
+        """
+        self.outbox.append((key, self.run_in, (callback, int(delay) + 1), kwargs))
+
+
+    def flush(self):
+        """ the queued calls are sent by drain once the callback is done deciding
+        """
+        pass
+
+
+    async def drain(self):
+        """ this sends everything the callback decided on, the service calls concurrently
+        """
+        await self.post()
+        await self.dispatch()
+        # the queue may have set a timer for what it couldn't send yet
+        await self.post()
+
+
+    async def post(self):
+        """ this sends the rule text and timers waiting in the outbox
+        """
+        outbox, self.outbox = self.outbox, []
+        for key, func, args, kwargs in outbox:
+            if key is not None and key in self.timers:
+                await self.cancel_timer(self.timers.pop(key))
+            result = await func(*args, **kwargs)
+            if key is not None:
+                self.timers[key] = result
+
+
+    async def dispatch(self):
+        """ this sends the queued calls a stage at a time, the calls in a stage all at once
+            but never more than LIMIT waiting on HA
+        """
+        now = self.clock
+        commands, taken = self.take(now)
+        failed = set()
+        sentto = {}
+        limit = asyncio.Semaphore(self.LIMIT)
+
+        async def send(service, units, params):
+            async with limit:
+                try:
+                    await self.call_service(service, entity_id=units if len(units) > 1 else units[0], **params)
+                    self.metrics.sent(units)
+                    for unit in units:
+                        sentto[unit] = sentto.get(unit, 0) + 1
+                except Exception as e:
+                    self.log(service + " to " + ",".join(units) + " failed: " + str(e), level="WARNING")
+                    failed.update(units)
+
+        for stage, calls in itertools.groupby(batch(commands), key=lambda call: call[0]):
+            calls = [(service, [u for u in units if u not in failed], params) for stage, service, units, params in calls]
+            await asyncio.gather(*[send(service, units, params) for service, units, params in calls if units])
+        self.done(taken, failed, now)
+        self.finished(sentto)
@@ -0,0 +1,888 @@
+############################################################
+#
+# The climate control policy, without AppDaemon
+#
+# the thresholds, snapshot, decision table and action plans, the instrumentation,
+# time windows and zones. Nothing here talks to HA or imports AppDaemon, so the
+# policy can be run, swept and benchmarked from any runtime, the hass.Hass app in
+# climatecontrol.py is an adapter that feeds it states and sends its calls
+#
+############################################################
+
+import bisect
+import collections
+import csv
+import datetime
+import json
+import math
+import mmap
+import operator
+import os
+import struct
+import time
+from collections import namedtuple
+
+############################################################
+#
+# Decision table
+#
+# the climate policy is a list of rules, checked in order, the first one that
+# matches decides what every device type does. Each rule lists the tests it
+# needs to hold, the tests are worked out once per evaluation and packed
+# into a bitmask so matching a rule is a single and/compare
+#
+############################################################
+
+# everything the policy looks at, read once per evaluation
+# trigger is "away" when the presence flag changed, otherwise "temp"
+# precool and preheat are set by the thermal model when it's time to get ahead of the day
+Snapshot = namedtuple("Snapshot", "trigger cin cext fhigh solar away afternoon precool preheat")
+
+# the tests the rules are built from, the bit for each is its position here
+# name, snapshot field, comparison, user value (or a fixed value) to compare with
+TESTS = (
+    ("AWAYTRIG", "trigger", "==", "away"),
+    ("AWAY", "away", "==", True),
+    ("ABOVE_EXTHIGH", "cin", ">", "EXTHIGH"),
+    ("BELOW_EXTLOW", "cin", "<", "EXTLOW"),
+    ("ABOVE_OPTLOW", "cin", ">", "OPTLOW"),
+    ("BELOW_OPTLOW", "cin", "<", "OPTLOW"),
+    ("ABOVE_OPTHIGH", "cin", ">", "OPTHIGH"),
+    ("BELOW_INTHIGH", "cin", "<", "INTHIGH"),
+    ("ABOVE_INTHIGH", "cin", ">", "INTHIGH"),
+    ("BELOW_INTLOW", "cin", "<", "INTLOW"),
+    ("EXT_HOT", "cext", ">", "OPTHIGH"),
+    ("FC_HOT", "fhigh", ">", "OPTHIGH"),
+    ("FC_HIGH", "fhigh", ">=", "INTHIGH"),
+    ("FC_LOW", "fhigh", "<=", "OPTLOW"),
+    ("SOLAR", "solar", "==", True),
+    ("PM", "afternoon", "==", True),
+    ("PRECOOL", "precool", "==", True),
+    ("PREHEAT", "preheat", "==", True),
+)
+BIT = dict((test[0], 1 << i) for i, test in enumerate(TESTS))
+
+# comparison and which way the hysteresis band pushes the threshold before the test is true
+OPS = {">": (operator.gt, 1), ">=": (operator.ge, 1), "<": (operator.lt, -1), "<=": (operator.le, -1), "==": (operator.eq, 0)}
+CHECKS = tuple((1 << i, field, OPS[op][0], OPS[op][1], ref) for i, (name, field, op, ref) in enumerate(TESTS))
+
+# the inputs each test reads, its snapshot field and the user value it compares with, if any
+USERKEYS = ("EXTHIGH", "INTHIGH", "OPTHIGH", "OPTLOW", "INTLOW", "EXTLOW")
+READS = tuple((1 << i, (field, ref) if ref in USERKEYS else (field,)) for i, (name, field, op, ref) in enumerate(TESTS))
+
+# what each device type does: ("off",) or ("on", hvac mode, threshold to aim for, fan speed)
+OFF = ("off",)
+FANON = ("on", "fan_only", None, "Low")
+
+# name, tests that must all hold, AC, FAN, HEATER
+# a rule name of None means leave everything as it is
+RULES = (
+    ("All Away - Off", "AWAYTRIG AWAY", OFF, OFF, OFF),
+    ("Above Ext High - Cooling", "ABOVE_EXTHIGH", ("on", "cool", "INTHIGH", "High"), FANON, OFF),
+    ("Below Ext Low - Heating", "BELOW_EXTLOW", ("on", "heat", "INTLOW", "High"), OFF, ("on", "heat", "INTLOW", None)),
+    ("Pre-cooling", "PRECOOL", ("on", "cool", "OPTHIGH", "Low"), FANON, OFF),
+    ("Pre-heating", "PREHEAT", ("on", "heat", "OPTLOW", "Low"), OFF, ("on", "heat", "OPTLOW", None)),
+    ("Goldilocks (Hot out) - AC Fans", "ABOVE_OPTLOW BELOW_INTHIGH EXT_HOT", OFF, FANON, OFF),
+    ("Goldilocks (Hot Soon) - Fans", "ABOVE_OPTLOW BELOW_INTHIGH FC_HOT", OFF, FANON, OFF),
+    ("Goldilocks", "ABOVE_OPTLOW BELOW_INTHIGH", OFF, OFF, OFF),
+    ("All Away - Complex Off", "AWAY", OFF, OFF, OFF),
+    # after 2pm ignore the forecast and just work on the inside temp
+    ("Solar - Heating to Optimal", "PM SOLAR BELOW_OPTLOW", ("on", "heat", "OPTHIGH", "Low"), OFF, ("on", "heat", "OPTHIGH", None)),
+    ("Cooling to Optimum Low (>2pm)", "PM SOLAR ABOVE_OPTHIGH", ("on", "cool", "OPTLOW", "Low"), FANON, OFF),
+    ("Solar - Small Heaters to Optimal", "PM SOLAR", OFF, OFF, ("on", "heat", "OPTLOW", None)),
+    ("Heating to Internal Low", "PM BELOW_INTLOW", ("on", "heat", "INTLOW", "Mid"), OFF, ("on", "heat", "INTLOW", None)),
+    ("Cooling to Internal High (>2pm)", "PM ABOVE_INTHIGH", ("on", "cool", "INTHIGH", "Low"), FANON, OFF),
+    ("Internal Good - All Off", "PM", OFF, OFF, OFF),
+    # early in the day and the forecast is going to be high
+    ("Solar - Cooling to Optimal", "FC_HIGH SOLAR ABOVE_OPTHIGH", ("on", "cool", "OPTHIGH", "Low"), FANON, OFF),
+    ("Solar - Fans (Forecast Hot)", "FC_HIGH SOLAR EXT_HOT", OFF, FANON, OFF),
+    ("Solar - Goldilocks", "FC_HIGH SOLAR", OFF, OFF, OFF),
+    ("Cooling to Internal High", "FC_HIGH ABOVE_INTHIGH", ("on", "cool", "INTHIGH", "Mid"), FANON, OFF),
+    ("Fans (is hot out)", "FC_HIGH ABOVE_OPTLOW EXT_HOT", OFF, FANON, OFF),
+    ("Goldilocks (No Solar, Warm out)", "FC_HIGH ABOVE_OPTLOW", OFF, OFF, OFF),
+    ("Goldilocks (No Solar)", "FC_HIGH", OFF, OFF, OFF),
+    # early in the day and the forecast is going to be low
+    ("(F) Solar - Heating to Optimal", "FC_LOW SOLAR BELOW_OPTLOW", ("on", "heat", "OPTLOW", "Low"), OFF, ("on", "heat", "OPTLOW", None)),
+    ("(F) Solar - Small Heaters to Optimal", "FC_LOW SOLAR", OFF, OFF, ("on", "heat", "OPTLOW", None)),
+    ("(F) Heating to Internal Low", "FC_LOW BELOW_INTLOW", ("on", "heat", "INTLOW", "Mid"), OFF, ("on", "heat", "INTLOW", None)),
+    ("(F) Small Heaters to Internal Low", "FC_LOW", OFF, OFF, ("on", "heat", "INTLOW", None)),
+    # if the forecast is in the middle then we let the house cool or heat naturally
+    (None, "", OFF, OFF, OFF),
+)
+
+
+def compile_rules(rules):
+    """ this turns each rule's list of tests into a bitmask
+    """
+    compiled = []
+    for name, tests, ac, fan, heater in rules:
+        mask = 0
+        for test in tests.split():
+            mask |= BIT[test]
+        compiled.append((mask, name, {"AC": ac, "FAN": fan, "HEATER": heater}))
+    return tuple(compiled)
+
+
+COMPILED = compile_rules(RULES)
+
+# the rules that only hold while there's solar to spare, the power budget applies under them
+SOLARRULES = frozenset(name for mask, name, plan in COMPILED if name and mask & BIT["SOLAR"])
+
+
+def tofloat(val):
+    """ this will turn a state into a number, or None if it isn't one (eg unavailable)
+    """
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def median(vals):
+    """ this is the middle of a list of numbers, or the mean of the middle two
+    """
+    vals = sorted(vals)
+    mid = len(vals) // 2
+    return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2
+
+
+def devicestate(state):
+    """ this pulls the parts of a device's HA state that the reconciler cares about, and what
+        the device says it can do (None where it doesn't say)
+    """
+    state = state or {}
+    attrs = state.get("attributes") or {}
+    return {"state": state.get("state"), "fan_mode": attrs.get("fan_mode"), "temperature": tofloat(attrs.get("temperature")),
+            "hvac_modes": tuple(attrs["hvac_modes"]) if attrs.get("hvac_modes") else None,
+            "fan_modes": tuple(attrs["fan_modes"]) if attrs.get("fan_modes") else None,
+            "min_temp": tofloat(attrs.get("min_temp")), "max_temp": tofloat(attrs.get("max_temp"))}
+
+
+def fit(aftype, want, have):
+    """ this checks a desired state against what the device can do, before anything is sent
+        the fan speed is matched whatever its case (and left alone if the device has nothing like it)
+        and the temperature is kept in the device's range. Returns the state to ask for, and why
+        it can't be done or None
+    """
+    want = dict(want)
+    if aftype not in ("AC", "HEATER") or want["state"] == "off":
+        return want, None
+    modes = have.get("hvac_modes")
+    if modes and want["state"] not in modes:
+        return want, "has no " + want["state"] + " mode, only " + ", ".join(modes)
+    speeds = have.get("fan_modes")
+    if want.get("fan_mode") is not None and speeds and want["fan_mode"] not in speeds:
+        want["fan_mode"] = next((speed for speed in speeds if speed.lower() == want["fan_mode"].lower()), None)
+    temp = want.get("temperature")
+    if temp is not None:
+        if have.get("min_temp") is not None:
+            temp = max(temp, have["min_temp"])
+        if have.get("max_temp") is not None:
+            temp = min(temp, have["max_temp"])
+        want["temperature"] = temp
+    return want, None
+
+
+def diff(aftype, want, have):
+    """ this lists the service calls that take a device from the state it has to the state we want
+    """
+    calls = []
+    if aftype == "LIGHT":
+        # a warning, sent every time it's asked for
+        calls.append(("light/turn_on", {"brightness": want["brightness"]}))
+    elif want["state"] == "off":
+        if have["state"] != "off":
+            calls.append(("fan/turn_off" if aftype == "FAN" else "climate/turn_off", {}))
+    elif aftype == "FAN":
+        if have["state"] == "off":
+            calls.append(("fan/increase_speed", {}))
+    else:
+        mode, temp = want["state"], want.get("temperature")
+        # setting the temperature with a mode also switches the mode, saving a call
+        if have["state"] != mode:
+            if mode == "fan_only" or temp is None:
+                calls.append(("climate/set_hvac_mode", {"hvac_mode": mode}))
+            else:
+                calls.append(("climate/set_temperature", {"hvac_mode": mode, "temperature": temp}))
+        elif mode != "fan_only" and temp is not None and (have["temperature"] is None or abs(have["temperature"] - temp) > 0.05):
+            calls.append(("climate/set_temperature", {"temperature": temp}))
+        if want.get("fan_mode") is not None and have["fan_mode"] != want["fan_mode"]:
+            calls.append(("climate/set_fan_mode", {"fan_mode": want["fan_mode"]}))
+    return calls
+
+
+def drawing(aftype, state):
+    """ this says if a device in this state is heating or cooling, and so drawing real power
+    """
+    return aftype in ("AC", "HEATER") and state.get("state") not in (None, "off", "fan_only")
+
+
+def batch(commands):
+    """ this groups (stage, service, entity, params) commands into one (stage, service, entities, params) call each
+        a device's calls are in increasing stages so sending stage by stage keeps them in order
+    """
+    groups = {}
+    for stage, service, unit, params in commands:
+        key = (stage, service, tuple(sorted(params.items())))
+        units = groups.setdefault(key, [])
+        if unit not in units:
+            units.append(unit)
+    return [(stage, service, units, dict(params)) for (stage, service, params), units in sorted(groups.items(), key=lambda g: g[0][0])]
+
+
+def features(snap, th, prev=0, band=None):
+    """ this works out every test once and packs the results into a bitmask
+        a test against a user value has to clear the hysteresis band to change from
+        what it was last time (prev), so a reading hovering on a threshold doesn't flip it
+    """
+    bits = 0
+    for bit, field, op, sign, ref in CHECKS:
+        val = getattr(snap, field)
+        if sign == 0:
+            hit = val == ref
+        elif val is None:
+            hit = False
+        elif ref in th:
+            h = band.get(ref, 0.0) if band else 0.0
+            hit = op(val, th[ref] + (-sign * h if prev & bit else sign * h))
+        else:
+            hit = op(val, ref)
+        if hit:
+            bits |= bit
+    return bits
+
+
+def decide(snap, th, prev=0, band=None):
+    """ this is the whole climate policy, it takes a snapshot and the parsed user values
+        and returns the rule name, what each device type should do, the test bits and
+        the tests looked at on the way (only they can change the answer), no I/O
+    """
+    bits = features(snap, th, prev, band)
+    used = 0
+    for mask, name, plan in COMPILED:
+        used |= mask
+        if bits & mask == mask:
+            return name, resolve(plan, th), bits, used
+
+
+def reads(used):
+    """ this lists the snapshot fields and user values behind a set of tests
+    """
+    out = set()
+    for bit, names in READS:
+        if used & bit:
+            out.update(names)
+    return frozenset(out)
+
+
+def resolve(plan, th):
+    """ this swaps the threshold names in a plan for their values
+    """
+    out = {}
+    for aftype, action in plan.items():
+        if action[0] == "on" and action[2] is not None:
+            action = ("on", action[1], th[action[2]], action[3])
+        out[aftype] = action
+    return out
+
+############################################################
+#
+# Instrumentation
+#
+# counters and histograms kept in plain lists and dicts so recording is a few
+# integer increments, published every so often to HA and a Prometheus file
+#
+############################################################
+
+class Metrics:
+    """ the app's running counters, cheap enough to leave on
+    """
+
+    LATENCY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0) # seconds
+    PEREVAL = (0, 1, 2, 4, 8, 16) # calls per evaluation
+
+    def __init__(self):
+        self.evaluations = 0
+        self.skipped = 0
+        self.filtered = 0 # inside readings that didn't move the smoothed temperature
+        self.queued = 0 # devices with commands waiting
+        self.coalesced = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0 # requests for a mode a device doesn't have
+        self.waiting = 0 # devices held back for want of power
+        self.latency = [0] * (len(self.LATENCY) + 1)
+        self.latencysum = 0.0
+        self.gets = 0
+        self.calls = 0
+        self.getsper = [0] * (len(self.PEREVAL) + 1)
+        self.callsper = [0] * (len(self.PEREVAL) + 1)
+        self.getssum = 0 # get_state calls made by evaluations, the histograms' sums
+        self.callssum = 0
+        self.devices = {}
+        self.transitions = 0
+        self.recent = collections.deque()
+        self.inrule = {}
+        self.rule = {}
+        self.since = {}
+
+
+    def start(self):
+        """ this marks the start of an evaluation
+        """
+        return (time.perf_counter(), self.gets, self.calls)
+
+
+    def finish(self, mark):
+        """ this records how long an evaluation took and the calls it made
+        """
+        took = time.perf_counter() - mark[0]
+        self.evaluations += 1
+        self.latencysum += took
+        self.latency[bisect.bisect_left(self.LATENCY, took)] += 1
+        self.getsper[bisect.bisect_left(self.PEREVAL, self.gets - mark[1])] += 1
+        self.callsper[bisect.bisect_left(self.PEREVAL, self.calls - mark[2])] += 1
+        self.getssum += self.gets - mark[1]
+        self.callssum += self.calls - mark[2]
+
+
+    def sent(self, units):
+        """ this counts a service call and the devices it went to
+        """
+        self.calls += 1
+        for unit in units:
+            self.devices[unit] = self.devices.get(unit, 0) + 1
+
+
+    def ruled(self, zone, rule, now):
+        """ this records a zone's change of rule and adds up the time spent in the last one
+        """
+        if zone in self.rule:
+            key = (zone, self.rule[zone])
+            self.inrule[key] = self.inrule.get(key, 0.0) + (now - self.since[zone]).total_seconds()
+            self.transitions += 1
+            self.recent.append(now)
+        self.rule[zone] = rule
+        self.since[zone] = now
+
+
+    def lasthour(self, now):
+        """ this is how many rule changes there have been in the last hour
+        """
+        while self.recent and (now - self.recent[0]).total_seconds() > 3600:
+            self.recent.popleft()
+        return len(self.recent)
+
+
+    def rulesecs(self, now):
+        """ this is the time spent in each (zone, rule), including the ones in force
+        """
+        secs = dict(self.inrule)
+        for zone, rule in self.rule.items():
+            secs[(zone, rule)] = secs.get((zone, rule), 0.0) + (now - self.since[zone]).total_seconds()
+        return secs
+
+
+    def attributes(self, now):
+        """ this is everything as HA sensor attributes
+        """
+        rulesecs = {}
+        for (zone, rule), secs in self.rulesecs(now).items():
+            rulesecs.setdefault(zone, {})[rule] = round(secs)
+        return {"evaluations": self.evaluations, "skipped": self.skipped, "filtered": self.filtered,
+                "queue_depth": self.queued, "power_waiting": self.waiting, "coalesced": self.coalesced, "retries": self.retries, "failures": self.failures,
+                "rejected": self.rejected,
+                "latency_avg_ms": round(1000 * self.latencysum / self.evaluations, 3) if self.evaluations else 0,
+                "latency_ms": dict(zip(LATENCYLABELS, self.latency)),
+                "get_state_total": self.gets, "call_service_total": self.calls,
+                "get_state_per_evaluation": dict(zip(PEREVALLABELS, self.getsper)),
+                "call_service_per_evaluation": dict(zip(PEREVALLABELS, self.callsper)),
+                "transitions_total": self.transitions, "transitions_last_hour": self.lasthour(now),
+                "rule_seconds": rulesecs,
+                "device_calls": dict(self.devices)}
+
+
+    def prometheus(self, now, prefix="climatecontrol"):
+        """ this is everything in Prometheus text format
+        """
+        lines = []
+        def metric(name, kind, helptext, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, helptext))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for suffix, tags, value in samples:
+                label = "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in tags) + "}" if tags else ""
+                lines.append("%s_%s%s%s %s" % (prefix, name, suffix, label, repr(float(value)) if isinstance(value, float) else value))
+        def buckets(bounds, counts, total):
+            out, running = [], 0
+            for bound, count in zip(bounds, counts):
+                running += count
+                out.append(("_bucket", [("le", bound)], running))
+            out.append(("_bucket", [("le", "+Inf")], running + counts[-1]))
+            out.append(("_sum", [], total))
+            out.append(("_count", [], running + counts[-1]))
+            return out
+
+        metric("evaluation_seconds", "histogram", "Time to decide and send one evaluation",
+               buckets(self.LATENCY, self.latency, self.latencysum))
+        metric("get_state_per_evaluation", "histogram", "get_state calls made by one evaluation",
+               buckets(self.PEREVAL, self.getsper, self.getssum))
+        metric("call_service_per_evaluation", "histogram", "call_service calls made by one evaluation",
+               buckets(self.PEREVAL, self.callsper, self.callssum))
+        metric("skipped_total", "counter", "Changes that no zone's decision depended on", [("", [], self.skipped)])
+        metric("filtered_total", "counter", "Inside readings that didn't move the smoothed temperature", [("", [], self.filtered)])
+        metric("queue_depth", "gauge", "Devices with commands waiting to be sent", [("", [], self.queued)])
+        metric("power_waiting", "gauge", "Devices waiting for the power to start", [("", [], self.waiting)])
+        metric("coalesced_total", "counter", "Waiting commands replaced by newer ones", [("", [], self.coalesced)])
+        metric("retries_total", "counter", "Failed sends tried again", [("", [], self.retries)])
+        metric("failures_total", "counter", "Sends given up on", [("", [], self.failures)])
+        metric("rejected_total", "counter", "Requests for a mode a device doesn't have", [("", [], self.rejected)])
+        metric("get_state_total", "counter", "get_state calls made", [("", [], self.gets)])
+        metric("call_service_total", "counter", "call_service calls made", [("", [], self.calls)])
+        metric("rule_transitions_total", "counter", "Changes of rule", [("", [], self.transitions)])
+        metric("rule_transitions_last_hour", "gauge", "Changes of rule in the last hour", [("", [], self.lasthour(now))])
+        metric("rule_seconds_total", "counter", "Time spent in each rule",
+               [("", [("zone", k[0]), ("rule", k[1])], v) for k, v in sorted(self.rulesecs(now).items())])
+        metric("device_calls_total", "counter", "call_service calls sent to each device",
+               [("", [("entity", k)], v) for k, v in sorted(self.devices.items())])
+        return "\n".join(lines) + "\n"
+
+
+def labels(bounds, scale=1):
+    """ this names histogram buckets by their upper bound for HA
+    """
+    return tuple("<=" + str(round(b * scale, 3)) for b in bounds) + (">" + str(round(bounds[-1] * scale, 3)),)
+
+
+LATENCYLABELS = labels(Metrics.LATENCY, 1000)
+PEREVALLABELS = labels(Metrics.PEREVAL)
+
+
+############################################################
+#
+# Time windows
+#
+# the parts of the day the policy treats differently, each is kept up to date
+# by a timer at its start and end rather than by looking at the clock each event
+#
+############################################################
+
+# name: (start, end), a window that ends before it starts runs past midnight
+WINDOWS = {
+    "afternoon": ("14:00", "00:00"), # the forecast matters less than the inside temperature
+    "heater_curfew": ("22:00", "05:00"), # the small heaters stay off overnight
+}
+
+
+def timeofday(val):
+    """ this turns "HH:MM" or "HH:MM:SS" into a time
+    """
+    return datetime.time.fromisoformat(str(val).strip())
+
+
+def inwindow(start, end, t):
+    """ this says if time of day t is in the window from start up to end
+    """
+    if start <= end:
+        return start <= t < end
+    return t >= start or t < end
+
+
+############################################################
+#
+# Zones
+#
+# an area of the house with its own inside sensor, user values and devices
+# the forecast, outside temperature, solar and presence are shared by all of them
+#
+############################################################
+
+# the user values: the key in apps.yaml and what we call it in the log
+USERVALUES = (("EXTHIGH", "exthigh", "Maximum External High"), ("INTHIGH", "inthigh", "Internal High"),
+              ("OPTHIGH", "opthigh", "Optimal High"), ("OPTLOW", "optlow", "Optimal Low"),
+              ("INTLOW", "intlow", "Internal Low"), ("EXTLOW", "extlow", "Maximum Low"))
+
+
+class Thresholds:
+    """ the six user values as numbers, checked and then fixed, so a decision never sees a half made change
+        they have to go EXTLOW < INTLOW < OPTLOW < OPTHIGH < INTHIGH < EXTHIGH, a change makes a new one
+    """
+
+    __slots__ = USERKEYS
+
+    def __init__(self, **values):
+        for key in USERKEYS:
+            val = tofloat(values.get(key))
+            if val is None or val != val or val in (float("inf"), float("-inf")):
+                raise ValueError("%s is %r, not a number" % (key, values.get(key)))
+            object.__setattr__(self, key, val)
+        order = USERKEYS[::-1]
+        for low, high in zip(order, order[1:]):
+            if not getattr(self, low) < getattr(self, high):
+                raise ValueError("%s %s has to be below %s %s" % (low, getattr(self, low), high, getattr(self, high)))
+
+    def __setattr__(self, key, val):
+        raise AttributeError("thresholds can't be changed, make new ones with replace()")
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in USERKEYS
+
+    def __repr__(self):
+        return "Thresholds(%s)" % ", ".join("%s=%s" % (key, getattr(self, key)) for key in USERKEYS)
+
+    def replace(self, **values):
+        """ this makes a copy with some values changed, checked the same way
+        """
+        new = dict((key, getattr(self, key)) for key in USERKEYS)
+        new.update(values)
+        return Thresholds(**new)
+
+
+def entitylist(val):
+    """ this turns a comma separated string (or a yaml list) of entities into a list
+    """
+    if not val:
+        return []
+    if isinstance(val, str):
+        val = val.split(',')
+    return [x.strip() for x in val if x.strip()]
+
+
+class Fusion:
+    """ the inside temperature from one or more sensors, combined, smoothed and only moved
+        in resolution steps, so a noisy or missing reading doesn't flip the rule
+    """
+
+    def __init__(self, method="median", weights=None, smoothing=0.0, outlier=3.0, stale=3600, resolution=0.1):
+        self.method = method
+        self.weights = weights or {}
+        self.smoothing = smoothing # seconds the smoothed value takes to get 63% of the way to a new reading, 0 for none
+        self.outlier = outlier
+        self.stale = stale
+        self.resolution = resolution
+        self.readings = {} # sensor: (value, when it was last heard from)
+        self.fused = None # the sensors combined, what the smoothed value heads for
+        self.smooth = None # the running average
+        self.since = None # when the running average was last moved
+        self.value = None # the value decisions see
+
+    def update(self, sensor, val, now):
+        """ this takes a new reading and says if the value decisions see has moved
+        """
+        val = tofloat(val)
+        if val is None or val != val:
+            self.readings.pop(sensor, None)
+        else:
+            self.readings[sensor] = (val, now)
+        fresh = [(s, v) for s, (v, t) in self.readings.items() if (now - t).total_seconds() <= self.stale]
+        if not fresh:
+            return False
+        # too far from the rest, or with too few to compare from where we were, is an outlier
+        mid = median([v for s, v in fresh]) if len(fresh) >= 3 else self.smooth
+        if mid is not None:
+            fresh = [(s, v) for s, v in fresh if abs(v - mid) <= self.outlier] or fresh
+        if self.method == "mean":
+            total = sum(self.weights.get(s, 1.0) for s, v in fresh)
+            fused = sum(self.weights.get(s, 1.0) * v for s, v in fresh) / total if total else fresh[0][1]
+        else:
+            fused = median([v for s, v in fresh])
+        # the average catches up on the time the last reading held, then heads for this one
+        self.advance(now)
+        self.fused = fused
+        if self.smooth is None or self.smoothing <= 0:
+            self.smooth = fused
+        return self.move()
+
+    def advance(self, now):
+        """ this moves the smoothed value on by the time since it last moved, toward the
+            readings as they stand, and says if the value decisions see has moved
+            a reading that holds steady sends no updates, so this is also called on a timer
+        """
+        if self.smooth is not None and self.since is not None and self.smoothing > 0:
+            secs = (now - self.since).total_seconds()
+            self.smooth += (1 - math.exp(-max(secs, 0) / self.smoothing)) * (self.fused - self.smooth)
+        self.since = now
+        return self.move()
+
+    def move(self):
+        if self.smooth is None or (self.value is not None and abs(self.smooth - self.value) < self.resolution):
+            return False
+        self.value = round(self.smooth, 3)
+        return True
+
+    def settling(self):
+        """ this says if the value decisions see still has a step or more to go
+        """
+        return self.fused is not None and (self.value is None or abs(self.fused - self.value) >= self.resolution)
+
+    def heard(self, sensor, when):
+        """ this notes a sensor was still reporting at when, HA only says so when the value changes
+        """
+        if sensor in self.readings and when > self.readings[sensor][1]:
+            self.readings[sensor] = (self.readings[sensor][0], when)
+
+    def lapsed(self, now):
+        """ this lists the sensors we haven't heard from for longer than stale
+        """
+        return [s for s, (v, t) in self.readings.items() if (now - t).total_seconds() > self.stale]
+
+
+class Zone:
+    """ one area under control, user values not given for a zone come from the app's own
+    """
+
+    def __init__(self, name, args, base=None):
+        base = base or {}
+        self.name = name
+        self.SENSORS = entitylist(args.get("cinttemp", base.get("cinttemp")))
+        def setting(key, default):
+            return args.get(key, base.get(key, default))
+        self.inside = Fusion(setting("fusion", "median"), setting("sensor_weights", {}), float(setting("smoothing", 0)),
+                             float(setting("outlier", 3.0)), float(setting("stale", 3600)), float(setting("resolution", 0.1)))
+        # several zones writing one input_text would overwrite each other, so each has its own
+        self.ACRULE = args.get("acrule")
+        for key, arg, label in USERVALUES:
+            setattr(self, key + "N", args.get(arg, base.get(arg)))
+        self.th = None # the user values in force, None until a valid set has been read
+        self.AIRCON = entitylist(args.get("aircon"))
+        self.FAN = entitylist(args.get("fan"))
+        self.HEATER = entitylist(args.get("heater"))
+        self.rule = None # the rule in force
+        self.rulesince = None # when it came into force
+        self.published = None # the rule text last put on ACRULE
+        self.bits = 0 # the test results the rule came from
+        self.deps = None # the inputs the last decision depended on, None for all of them
+        self.model = None # the zone's thermal model, if one has been fitted
+        self.pre = None # "cool" or "heat" while the model says to get ahead of the day
+        self.fields = dict([(sensor, "cin") for sensor in self.SENSORS] + [(getattr(self, key + "N"), key) for key, arg, label in USERVALUES])
+
+
+    def depends(self, entity):
+        """ this says if a change to entity could change this zone's decision
+        """
+        return self.deps is None or self.fields.get(entity) in self.deps
+
+
+    def inputs(self):
+        """ this is every entity only this zone's decision reads
+        """
+        return self.SENSORS + [getattr(self, key + "N") for key, arg, label in USERVALUES]
+
+
+############################################################
+#
+# Thermal model
+#
+# a first order (RC) model of a zone, the inside temperature heads for the
+# outside at a rate set by how leaky the house is, pushed along by whatever
+# is running, fitted offline from history by tools/thermal.py
+#
+#   dT/dt = loss * (outside - inside) + sum(gain * amount running) + bias    (per hour)
+#
+############################################################
+
+class ThermalModel:
+    """ the fitted model of one zone, and what it says about getting to a temperature in time
+    """
+
+    __slots__ = ("loss", "gains", "bias")
+
+    def __init__(self, loss, gains, bias=0.0, **fit):
+        self.loss = float(loss)
+        self.gains = dict((k, float(v)) for k, v in gains.items())
+        self.bias = float(bias)
+
+    def predict(self, inside, outside, hours, running=None):
+        """ this is the inside temperature after hours with the outside and what's running held steady
+        """
+        drive = sum(self.gains.get(k, 0.0) * n for k, n in (running or {}).items()) + self.bias
+        if self.loss <= 0:
+            return inside + drive * hours
+        settle = outside + drive / self.loss
+        return settle + (inside - settle) * math.exp(-self.loss * hours)
+
+    def start(self, inside, outside, hours, target, running, free=None):
+        """ this is how many hours from now to switch on what's running so the inside is at target
+            (or the right side of it) in hours time, as late as possible so it runs the least
+            None if there's no need, 0 if it should already be running
+        """
+        warmer = self.predict(inside, outside, hours, running) > self.predict(inside, outside, hours, free)
+        def short(after):
+            # still the wrong side of the target if we wait this long to start
+            mid = self.predict(inside, outside, after, free)
+            end = self.predict(mid, outside, hours - after, running)
+            return end < target if warmer else end > target
+        if not short(hours):
+            return None
+        if short(0):
+            return 0.0
+        low, high = 0.0, hours
+        for i in range(30):
+            mid = (low + high) / 2
+            if short(mid):
+                high = mid
+            else:
+                low = mid
+        return low
+
+
+############################################################
+#
+# Telemetry
+#
+# every evaluation as a fixed size record in a ring buffer kept in a memory
+# mapped file, so months of decisions cost a few MB, survive a restart and can
+# be read by another process (tools/telemetry.py) while the app writes
+#
+# the file is a header (magic, version, record size, capacity, records ever
+# written), a table naming the zones and rules the records refer to by number,
+# then capacity records, the oldest overwritten once it's full. Names are only
+# ever added to the table, so changing the rules or zones never relabels old records
+#
+############################################################
+
+class Telemetry:
+    """ the ring buffer of evaluations, opened to write with a capacity or read only without
+    """
+
+    HEADER = struct.Struct("<4sHHIQ")
+    COUNT = 12 # where the records ever written are in the header
+    TABLE = 8192 # bytes kept for the table of names, JSON
+    RECORD = struct.Struct("<dHhBBfffH") # time, zone, rule, trigger, flags, cin, cext, fhigh, calls
+    MAGIC = b"CCRB"
+    VERSION = 2
+    TRIGGERS = ("temp", "away")
+    FLAGS = ("solar", "away", "afternoon", "precool", "preheat", "held")
+    FIELDS = ("time", "zone", "rule", "trigger", "cin", "cext", "fhigh") + FLAGS + ("calls",)
+
+    def __init__(self, path, capacity=None, zones=()):
+        self.path = path
+        self.start = self.HEADER.size + self.TABLE
+        size = self.start + (capacity or 0) * self.RECORD.size
+        if capacity is None:
+            with open(path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # a file of another shape (or none) is started again
+            if not os.path.exists(path) or os.path.getsize(path) != size or self.header(path) != (self.MAGIC, self.VERSION, self.RECORD.size, capacity):
+                with open(path, "wb") as f:
+                    f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size, capacity, 0))
+                    f.write(json.dumps({"zones": [], "rules": []}).encode())
+                    f.truncate(size)
+            with open(path, "r+b") as f:
+                self.map = mmap.mmap(f.fileno(), size)
+        magic, version, recsize, self.capacity, self.count = self.HEADER.unpack_from(self.map, 0)
+        if (magic, version, recsize) != (self.MAGIC, self.VERSION, self.RECORD.size):
+            raise ValueError(path + " isn't a climatecontrol telemetry file of this version")
+        self.names = self.table()
+        if capacity is not None:
+            # every name we'll write, up front, so a table too big for the file is found at start up
+            for zone in zones:
+                self.number("zones", zone)
+            for rule in RULES:
+                if rule[0] is not None:
+                    self.number("rules", rule[0])
+
+
+    def header(self, path):
+        with open(path, "rb") as f:
+            return self.HEADER.unpack(f.read(self.HEADER.size))[:4]
+
+
+    def table(self):
+        """ this reads the names the records' numbers stand for
+        """
+        return json.loads(bytes(self.map[self.HEADER.size:self.start]).rstrip(b"\0").decode())
+
+
+    def number(self, kind, name):
+        """ this is the number a zone or rule is recorded as, adding it to the table if it's new
+        """
+        names = self.names[kind]
+        if name in names:
+            return names.index(name)
+        table = json.dumps(dict(self.names, **{kind: names + [name]})).encode()
+        if len(table) > self.TABLE:
+            raise ValueError("too many zone and rule names for the telemetry file")
+        names.append(name)
+        self.map[self.HEADER.size:self.HEADER.size + len(table)] = table
+        return len(names) - 1
+
+
+    def record(self, now, zone, snap, rule, held=False, calls=0):
+        """ this adds one evaluation of a zone, the rule is None when the table left things as they were
+            calls is the service calls sent to the zone's devices as the evaluation finished
+        """
+        def num(val):
+            return float("nan") if val is None else val
+        flags = 0
+        for i, on in enumerate((snap.solar, snap.away, snap.afternoon, snap.precool, snap.preheat, held)):
+            if on:
+                flags |= 1 << i
+        rid = -1 if rule is None else self.number("rules", rule)
+        self.RECORD.pack_into(self.map, self.start + (self.count % self.capacity) * self.RECORD.size,
+                              now.timestamp(), self.number("zones", zone), rid, self.TRIGGERS.index(snap.trigger), flags,
+                              num(snap.cin), num(snap.cext), num(snap.fhigh), min(calls, 65535))
+        # the count goes last so a reader never sees a record before it's all there
+        self.count += 1
+        struct.pack_into("<Q", self.map, self.COUNT, self.count)
+
+
+    def rows(self):
+        """ this is every record held, oldest first, as a tuple in FIELDS order
+        """
+        self.count = struct.unpack_from("<Q", self.map, self.COUNT)[0]
+        self.names = self.table()
+        zones, rules = self.names["zones"], self.names["rules"]
+        size = self.RECORD.size
+        body = memoryview(self.map)[self.start:self.start + self.capacity * size]
+        if self.count <= self.capacity:
+            parts = (body[:self.count * size],)
+        else:
+            first = self.count % self.capacity
+            parts = (body[first * size:], body[:first * size])
+        def num(val):
+            # the inputs are kept as float32, NaN for a missing reading
+            return None if val != val else round(val, 2)
+        for part in parts:
+            for t, zone, rid, trigger, flags, cin, cext, fhigh, calls in self.RECORD.iter_unpack(part):
+                yield ((t, zones[zone], rules[rid] if rid >= 0 else None, self.TRIGGERS[trigger],
+                        num(cin), num(cext), num(fhigh))
+                       + tuple(bool(flags >> i & 1) for i in range(len(self.FLAGS))) + (calls,))
+
+
+    def query(self, since=None, until=None, zone=None, rule=None):
+        """ this lists the evaluations between two datetimes, for one zone or rule if given, as dicts
+        """
+        since = since.timestamp() if since else float("-inf")
+        until = until.timestamp() if until else float("inf")
+        out = []
+        for row in self.rows():
+            if since <= row[0] < until and zone in (None, row[1]) and rule in (None, row[2]):
+                row = dict(zip(self.FIELDS, row))
+                row["time"] = datetime.datetime.fromtimestamp(row["time"])
+                out.append(row)
+        return out
+
+
+    def close(self):
+        self.map.close()
+
+
+def export(rows, path):
+    """ this writes queried evaluations as CSV, or Parquet if the path ends .parquet (that needs pyarrow)
+    """
+    if path.endswith(".parquet"):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.table(dict((field, [row[field] for row in rows]) for field in Telemetry.FIELDS))
+        pyarrow.parquet.write_table(table, path)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=Telemetry.FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, time=row["time"].isoformat()))
+
@@ -0,0 +1,211 @@
+############################################################
+#
+# Tests for the policy in climatecore.py, which runs without AppDaemon
+#
+# python -m pytest tests
+#
+############################################################
+
+import datetime
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps", "climatecontrol"))
+
+import climatecore as cc
+
+TH = cc.Thresholds(EXTHIGH=30, INTHIGH=26, OPTHIGH=24, OPTLOW=20, INTLOW=18, EXTLOW=14)
+T0 = datetime.datetime(2021, 1, 4, 9, 0)
+
+
+def legacy(cin, cext, fhigh, solar, away, afternoon, th):
+    """ the nested if-tree main used to be, for a temperature change, as (rule, plan)
+    """
+    cool = lambda temp, spd: ("on", "cool", th[temp], spd)
+    heat = lambda temp, spd: ("on", "heat", th[temp], spd)
+    heater = lambda temp: ("on", "heat", th[temp], None)
+    def plan(name, ac=cc.OFF, fan=cc.OFF, htr=cc.OFF):
+        return name, {"AC": ac, "FAN": fan, "HEATER": htr}
+
+    if cin > th["EXTHIGH"]:
+        return plan("Above Ext High - Cooling", cool("INTHIGH", "High"), cc.FANON)
+    if cin < th["EXTLOW"]:
+        return plan("Below Ext Low - Heating", heat("INTLOW", "High"), cc.OFF, heater("INTLOW"))
+    if th["OPTLOW"] < cin < th["INTHIGH"]:
+        if cext > th["OPTHIGH"]:
+            return plan("Goldilocks (Hot out) - AC Fans", cc.OFF, cc.FANON)
+        if fhigh > th["OPTHIGH"]:
+            return plan("Goldilocks (Hot Soon) - Fans", cc.OFF, cc.FANON)
+        return plan("Goldilocks")
+    if away:
+        return plan("All Away - Complex Off")
+    if afternoon:
+        if solar:
+            if cin < th["OPTLOW"]:
+                return plan("Solar - Heating to Optimal", heat("OPTHIGH", "Low"), cc.OFF, heater("OPTHIGH"))
+            if cin > th["OPTHIGH"]:
+                return plan("Cooling to Optimum Low (>2pm)", cool("OPTLOW", "Low"), cc.FANON)
+            return plan("Solar - Small Heaters to Optimal", cc.OFF, cc.OFF, heater("OPTLOW"))
+        if cin < th["INTLOW"]:
+            return plan("Heating to Internal Low", heat("INTLOW", "Mid"), cc.OFF, heater("INTLOW"))
+        if cin > th["INTHIGH"]:
+            return plan("Cooling to Internal High (>2pm)", cool("INTHIGH", "Low"), cc.FANON)
+        return plan("Internal Good - All Off")
+    if fhigh >= th["INTHIGH"]:
+        if solar:
+            if cin > th["OPTHIGH"]:
+                return plan("Solar - Cooling to Optimal", cool("OPTHIGH", "Low"), cc.FANON)
+            if cext > th["OPTHIGH"]:
+                return plan("Solar - Fans (Forecast Hot)", cc.OFF, cc.FANON)
+            return plan("Solar - Goldilocks")
+        if cin > th["INTHIGH"]:
+            return plan("Cooling to Internal High", cool("INTHIGH", "Mid"), cc.FANON)
+        if cin > th["OPTLOW"]:
+            if cext > th["OPTHIGH"]:
+                return plan("Fans (is hot out)", cc.OFF, cc.FANON)
+            return plan("Goldilocks (No Solar, Warm out)")
+        return plan("Goldilocks (No Solar)")
+    if fhigh <= th["OPTLOW"]:
+        if solar:
+            if cin < th["OPTLOW"]:
+                return plan("(F) Solar - Heating to Optimal", heat("OPTLOW", "Low"), cc.OFF, heater("OPTLOW"))
+            return plan("(F) Solar - Small Heaters to Optimal", cc.OFF, cc.OFF, heater("OPTLOW"))
+        if cin < th["INTLOW"]:
+            return plan("(F) Heating to Internal Low", heat("INTLOW", "Mid"), cc.OFF, heater("INTLOW"))
+        return plan("(F) Small Heaters to Internal Low", cc.OFF, cc.OFF, heater("INTLOW"))
+    return None, None
+
+
+def snap(cin, cext=20.0, fhigh=22.0, solar=False, away=False, afternoon=False, trigger="temp"):
+    return cc.Snapshot(trigger, cin, cext, fhigh, solar, away, afternoon, False, False)
+
+
+# every threshold, and either side of it
+TEMPS = sorted(set(v + d for v in (30, 26, 24, 20, 18, 14) for d in (-0.5, 0, 0.5)) | {10.0, 35.0})
+
+
+def test_decide_matches_the_old_if_tree():
+    for cin, cext, fhigh, solar, away, afternoon in itertools.product(TEMPS, TEMPS, TEMPS, (False, True), (False, True), (False, True)):
+        rule, plan, bits, used = cc.decide(snap(cin, cext, fhigh, solar, away, afternoon), TH)
+        want_rule, want_plan = legacy(cin, cext, fhigh, solar, away, afternoon, TH)
+        assert rule == want_rule, (cin, cext, fhigh, solar, away, afternoon)
+        if want_rule is not None:
+            assert plan == want_plan, (cin, cext, fhigh, solar, away, afternoon)
+
+
+def test_everyone_leaving_turns_everything_off():
+    rule, plan, bits, used = cc.decide(snap(31.0, away=True, trigger="away"), TH)
+    assert rule == "All Away - Off"
+    assert plan == {"AC": cc.OFF, "FAN": cc.OFF, "HEATER": cc.OFF}
+
+
+def test_thresholds_parse_strings():
+    th = cc.Thresholds(EXTHIGH="30", INTHIGH="26.5", OPTHIGH=24, OPTLOW=20, INTLOW=18, EXTLOW=14)
+    assert th["INTHIGH"] == 26.5
+    assert th.replace(INTHIGH="27")["INTHIGH"] == 27.0
+
+
+@pytest.mark.parametrize("values", [
+    dict(EXTHIGH=30, INTHIGH=26, OPTHIGH=24, OPTLOW=24, INTLOW=18, EXTLOW=14), # not strictly in order
+    dict(EXTHIGH=30, INTHIGH=26, OPTHIGH=24, OPTLOW=20, INTLOW=18, EXTLOW=19),
+    dict(EXTHIGH=30, INTHIGH="unavailable", OPTHIGH=24, OPTLOW=20, INTLOW=18, EXTLOW=14),
+    dict(EXTHIGH=30, INTHIGH=26, OPTHIGH=24, OPTLOW=20, INTLOW=18),
+    dict(EXTHIGH="nan", INTHIGH=26, OPTHIGH=24, OPTLOW=20, INTLOW=18, EXTLOW=14),
+])
+def test_thresholds_reject_bad_values(values):
+    with pytest.raises(ValueError):
+        cc.Thresholds(**values)
+
+
+def test_thresholds_are_fixed():
+    with pytest.raises(AttributeError):
+        TH.INTHIGH = 27
+    with pytest.raises(ValueError):
+        TH.replace(INTHIGH=31)
+    assert TH["INTHIGH"] == 26
+
+
+def test_fusion_moves_in_resolution_steps():
+    f = cc.Fusion(resolution=0.5)
+    assert f.update("a", "22", T0)
+    assert not f.update("a", "22.3", T0 + datetime.timedelta(minutes=1))
+    assert f.update("a", "22.6", T0 + datetime.timedelta(minutes=2))
+    assert f.value == 22.6
+
+
+def test_fusion_ignores_unavailable_and_outliers():
+    f = cc.Fusion(resolution=0.1)
+    for sensor, val in (("a", "20"), ("b", "21"), ("c", "22")):
+        f.update(sensor, val, T0)
+    assert f.value == 21
+    f.update("c", "35", T0) # an outlier
+    assert f.value == 20.5
+    f.update("c", "unavailable", T0)
+    assert f.value == 20.5
+
+
+def test_fusion_drops_a_sensor_not_heard_from():
+    f = cc.Fusion(stale=3600, resolution=0.1)
+    f.update("a", "20", T0)
+    f.update("b", "22", T0)
+    assert f.value == 21
+    later = T0 + datetime.timedelta(hours=2)
+    # a still reports the same value, b has gone quiet
+    f.heard("a", later)
+    assert f.lapsed(later) == ["b"]
+    f.update("a", "20.2", later)
+    assert f.value == 20.2
+
+
+def test_fusion_keeps_a_steady_sensor_heard_from():
+    f = cc.Fusion(stale=3600, resolution=0.1)
+    f.update("a", "20", T0)
+    f.update("b", "22", T0)
+    later = T0 + datetime.timedelta(hours=2)
+    f.heard("a", later)
+    f.update("b", "22.4", later)
+    assert f.value == 21.2
+
+
+def test_diff_sends_only_what_changed():
+    have = cc.devicestate({"state": "cool", "attributes": {"temperature": 24.0, "fan_mode": "Low"}})
+    assert cc.diff("AC", {"state": "cool", "temperature": 24.0, "fan_mode": "Low"}, have) == []
+    calls = cc.diff("AC", {"state": "cool", "temperature": 22.0, "fan_mode": "Low"}, have)
+    assert calls == [("climate/set_temperature", {"temperature": 22.0})]
+
+
+def test_telemetry_round_trip(tmp_path):
+    path = str(tmp_path / "ring")
+    names = ["upstairs_bedroom", "upstairs_bedroom_2", "abcdefghijké"]
+    ring = cc.Telemetry(path, 4, names)
+    for i in range(6):
+        ring.record(T0 + datetime.timedelta(minutes=i), names[i % 3], snap(20.0 + i), "Goldilocks" if i % 2 else None, calls=i)
+    ring.close()
+    rows = cc.Telemetry(path).query()
+    assert [row["calls"] for row in rows] == [2, 3, 4, 5]
+    assert [row["zone"] for row in rows] == [names[2], names[0], names[1], names[2]]
+    assert len(cc.Telemetry(path).query(zone="upstairs_bedroom")) == 1
+
+
+def test_fusion_smoothing_catches_up_with_a_held_step():
+    f = cc.Fusion(smoothing=300, resolution=0.1)
+    f.update("a", "22", T0)
+    assert f.value == 22
+    # a step, then nothing more from the sensor as it holds
+    f.update("a", "28", T0 + datetime.timedelta(minutes=1))
+    assert f.value == 22 and f.settling()
+    f.advance(T0 + datetime.timedelta(minutes=6))
+    assert 25 < f.value < 28
+    f.advance(T0 + datetime.timedelta(minutes=60))
+    assert abs(f.value - 28) < 0.1
+    assert not f.settling()
+
+
+def test_fusion_without_smoothing_follows_each_reading():
+    f = cc.Fusion(smoothing=0, resolution=0.1)
+    f.update("a", "22", T0)
+    assert f.update("a", "28", T0 + datetime.timedelta(minutes=1))
+    assert f.value == 28
@@ -0,0 +1,171 @@
+############################################################
+#
+# Benchmarks every rule in Manage_Climate's decision table
+#
+# each case sets the house up so one named rule fires, then times the
+# event that fires it and counts the get_state and call_service calls it
+# made, using the simulator's stand in for hass.Hass so no AppDaemon or
+# HA is needed. The counts are checked against bench_baseline.json and
+# any case making more calls than its baseline fails the run
+#
+# python tools/bench.py            # run and check against the baseline
+# python tools/bench.py --update   # run and store the results as the baseline
+#
+############################################################
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+
+import simulate
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+ARGS = {
+    "fhigh": "sensor.temp_max_0", "flow": "sensor.temp_min_0", "cexttemp": "sensor.outside",
+    "cinttemp": "sensor.inside_now", "solarstatus": "input_boolean.power_ready",
+    "presenceaway": "input_boolean.presence_away",
+    "exthigh": "input_number.cc_exthigh", "inthigh": "input_number.cc_inthigh", "opthigh": "input_number.cc_opthigh",
+    "optlow": "input_number.cc_optlow", "intlow": "input_number.cc_intlow", "extlow": "input_number.cc_extlow",
+    "aircon": "climate.aircon", "fan": "fan.master,fan.one,fan.two,fan.lounge",
+    "heater": "climate.ensuite,climate.study,climate.lounge",
+    "door": "binary_sensor.fdoor_open,binary_sensor.bdoor_open", "acrule": "input_text.ac_rule",
+    "warnlight": "light.front_hall", "manual_override": "input_boolean.cc_ac_manual",
+    "dwell": 0, "device_dwell": 0,
+}
+
+USER = {"EXTHIGH": 30.0, "INTHIGH": 26.0, "OPTHIGH": 24.0, "OPTLOW": 20.0, "INTLOW": 18.0, "EXTLOW": 14.0}
+
+# every device running, so whichever rule fires has something to change
+RUNNING = {
+    "climate.aircon": ("cool", {"temperature": 25.0, "fan_mode": "Mid"}),
+    "fan.master": ("on", {}), "fan.one": ("on", {}), "fan.two": ("on", {}), "fan.lounge": ("on", {}),
+    "climate.ensuite": ("heat", {"temperature": 19.0}), "climate.study": ("heat", {"temperature": 19.0}),
+    "climate.lounge": ("heat", {"temperature": 19.0}),
+}
+
+
+def scenarios(cc):
+    """ this finds a set of inputs that fires each named rule, by asking the decision table
+    """
+    found = {}
+    grid = itertools.product(("temp", "away"), (10, 15, 19, 20, 21, 23, 25, 26, 27, 31), (15, 28), (15, 22, 28),
+                             (False, True), (False, True), (False, True), (False, True), (False, True))
+    for trigger, cin, cext, fhigh, solar, away, afternoon, precool, preheat in grid:
+        snap = cc.Snapshot(trigger, float(cin), float(cext), float(fhigh), solar, away, afternoon, precool, preheat)
+        rule = cc.decide(snap, USER)[0]
+        if rule is not None and rule not in found:
+            found[rule] = snap
+    return found
+
+
+def setup(snap=None):
+    """ this builds a simulated house with the app running and every device on
+    """
+    args = dict(ARGS)
+    start = datetime.datetime(2021, 1, 4, 15 if snap and snap.afternoon else 9, 0)
+    states = {ARGS["exthigh"]: "30", ARGS["inthigh"]: "26", ARGS["opthigh"]: "24",
+              ARGS["optlow"]: "20", ARGS["intlow"]: "18", ARGS["extlow"]: "14",
+              ARGS["manual_override"]: "off", ARGS["presenceaway"]: "off",
+              ARGS["cinttemp"]: "22", ARGS["cexttemp"]: "20", ARGS["fhigh"]: "22", ARGS["solarstatus"]: "off"}
+    if snap:
+        states.update({ARGS["cexttemp"]: str(snap.cext), ARGS["fhigh"]: str(snap.fhigh),
+                       ARGS["solarstatus"]: "on" if snap.solar else "off"})
+        if snap.trigger == "away":
+            states[ARGS["cinttemp"]] = str(snap.cin)
+    sim = simulate.simulate([], args, initial=states, start=start)
+    for unit, (state, attributes) in RUNNING.items():
+        sim.setstate(unit, state, attributes)
+    if snap and snap.away:
+        sim.app.cache[sim.app.AWAYN] = "on" if snap.trigger == "temp" else "off"
+    if snap and (snap.precool or snap.preheat):
+        # as the thermal model would have it
+        sim.app.zones[0].pre = "cool" if snap.precool else "heat"
+    sim.calls = []
+    return sim
+
+
+def measure(build, fire, repeat):
+    """ this times fire() on fresh houses and counts the calls it made on the last one
+    """
+    times = []
+    for i in range(repeat):
+        sim = build()
+        before = dict(sim.counts)
+        start = time.perf_counter()
+        fire(sim)
+        times.append(time.perf_counter() - start)
+    counts = dict((k, sim.counts[k] - before[k]) for k in before)
+    return statistics.median(times) * 1e6, counts, sim
+
+
+def cases(cc):
+    """ this lists every case as (name, build, fire, rule we expect to see or None)
+    """
+    out = []
+    for rule, snap in scenarios(cc).items():
+        if snap.trigger == "away":
+            fire = lambda sim: sim.setstate(sim.app.AWAYN, "on")
+        else:
+            fire = lambda sim, cin=str(snap.cin): sim.setstate(ARGS["cinttemp"], cin)
+        out.append(("main: " + rule, lambda snap=snap: setup(snap), fire, rule))
+    out.append(("ignorer: manual on", setup, lambda sim: sim.setstate(ARGS["manual_override"], "on"), "Manual"))
+    out.append(("ignorer: manual off", setup, lambda sim: sim.app.ignorer(ARGS["manual_override"], "state", "on", "off", {}), None))
+    out.append(("setvals: inthigh", setup, lambda sim: sim.setstate(ARGS["inthigh"], "27"), None))
+    out.append(("toff: AC", setup, lambda sim: sim.app.toff("climate.aircon", "AC"), None))
+    out.append(("toff: FAN", setup, lambda sim: sim.app.toff("fan.master", "FAN"), None))
+    out.append(("toff: HEATER", setup, lambda sim: sim.app.toff("climate.study", "HEATER"), None))
+    out.append(("ton: AC cool", setup, lambda sim: sim.app.ton("climate.aircon", "AC", mode="cool", temp=22.0, spd="High"), None))
+    out.append(("ton: AC heat", setup, lambda sim: sim.app.ton("climate.aircon", "AC", mode="heat", temp=21.0, spd="Low"), None))
+    out.append(("ton: HEATER", setup, lambda sim: sim.app.ton("climate.study", "HEATER", mode="heat", temp=21.0), None))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark every rule branch of Manage_Climate")
+    parser.add_argument("--repeat", type=int, default=50, help="fresh runs per case for the latency median")
+    parser.add_argument("--update", action="store_true", help="store these results as the new baseline")
+    opts = parser.parse_args()
+
+    cc = simulate.loadcore()
+    baseline = {}
+    if os.path.exists(BASELINE) and not opts.update:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results, failed = {}, []
+    print("%-48s %10s %10s %13s" % ("case", "us/event", "get_state", "call_service"))
+    for name, build, fire, rule in cases(cc):
+        latency, counts, sim = measure(build, fire, opts.repeat)
+        results[name] = counts
+        flag = ""
+        if rule is not None and (not sim.rules or sim.rules[-1][1] != rule):
+            flag = "  <- rule was %r" % (sim.rules[-1][1] if sim.rules else None)
+            failed.append(name)
+        for key, limit in baseline.get(name, {}).items():
+            if counts.get(key, 0) > limit:
+                flag += "  <- %s %d > baseline %d" % (key, counts[key], limit)
+                failed.append(name)
+        print("%-48s %10.1f %10d %13d%s" % (name, latency, counts["get_state"], counts["call_service"], flag))
+
+    missing = [name for name in baseline if name not in results]
+    for name in missing:
+        print("%-48s missing" % name)
+
+    if opts.update:
+        with open(BASELINE, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("baseline updated")
+    elif failed or missing:
+        print("FAILED: %d case(s) regressed" % len(set(failed + missing)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
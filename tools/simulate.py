@@ -0,0 +1,333 @@
+############################################################
+#
+# Replays recorded HA history through Manage_Climate offline
+#
+# a stand in for AppDaemon's hass.Hass runs the app in process on a
+# virtual clock, so a year of sensor readings replays in seconds and
+# policy changes can be tried without touching the real house
+#
+# python tools/simulate.py history.csv --config apps.yaml
+#
+############################################################
+
+############################################################
+#
+# The history is either a CSV with a header of
+#   time,entity,state
+# or JSONL with one state change per line
+#   {"time": "2021-01-05T14:00:00", "entity": "sensor.inside_now", "state": "24.5", "attributes": {}}
+# time is ISO 8601 or seconds since the epoch
+#
+# The config is the climatecontrol section of apps.yaml (YAML needs PyYAML,
+# JSON works without it). The output is JSONL, one line per rule change
+# {"time": ..., "rule": ...} and one per service call {"time": ..., "service": ..., "data": {...}}
+#
+############################################################
+
+import argparse
+import csv
+import datetime
+import heapq
+import json
+import os
+import sys
+import types
+
+APPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps", "climatecontrol")
+
+
+class Simulator:
+    """ the house as far as the app can tell: entity states, listeners, timers and a virtual clock
+    """
+
+    def __init__(self, start):
+        self.clock = start
+        self.states = {}
+        self.listeners = {}
+        self.timers = []
+        self.seq = 0
+        self.effects = []
+        self.pending = {} # each device as the calls sent so far will leave it, until they take effect
+        self.rules = []
+        self.calls = []
+        self.counts = {"get_state": 0, "call_service": 0}
+        self.verbose = False
+
+
+    def setstate(self, entity, state, attributes=None):
+        """ this changes an entity and tells whoever is listening, the way HA would
+        """
+        old = self.states.get(entity)
+        new = {"entity_id": entity, "state": state,
+               "attributes": dict(old["attributes"]) if old else {}}
+        if attributes:
+            new["attributes"].update(attributes)
+        if old is not None and old["state"] == new["state"] and old["attributes"] == new["attributes"]:
+            return
+        self.states[entity] = new
+        for attribute, callback, kwargs in list(self.listeners.get(entity, ())):
+            if attribute == "all":
+                callback(entity, "all", old, new, kwargs)
+            elif attribute is None:
+                if old is None or old["state"] != state:
+                    callback(entity, "state", old and old["state"], state, kwargs)
+            elif (old and old["attributes"].get(attribute)) != new["attributes"].get(attribute):
+                callback(entity, attribute, old and old["attributes"].get(attribute), new["attributes"].get(attribute), kwargs)
+        self.settle()
+
+
+    def settle(self):
+        """ this lets the devices act on the calls they were sent, after the callback that sent them is done
+        """
+        while self.effects:
+            effects, self.effects = self.effects, []
+            self.pending = {}
+            for entity, state, attributes in effects:
+                self.setstate(entity, state, attributes)
+
+
+    def service(self, service, data):
+        """ this records a service call and works out what it does to the devices
+        """
+        self.counts["call_service"] += 1
+        self.calls.append((self.clock, service, data))
+        units = data.get("entity_id") or []
+        if isinstance(units, str):
+            units = [units]
+        domain, action = service.split("/")
+        for unit in units:
+            # a later call builds on the earlier ones, not on the state before any of them
+            old = self.pending.get(unit) or self.states.get(unit, {"state": "off", "attributes": {}})
+            state, attributes = old["state"], {}
+            if action == "turn_off":
+                state = "off"
+            elif action == "set_hvac_mode":
+                state = data["hvac_mode"]
+            elif action == "set_temperature":
+                attributes["temperature"] = data["temperature"]
+                state = data.get("hvac_mode", state)
+            elif action == "set_fan_mode":
+                attributes["fan_mode"] = data["fan_mode"]
+            elif action in ("turn_on", "increase_speed"):
+                state = "on" if domain != "climate" else "heat" if state == "off" else state
+            self.pending[unit] = {"state": state, "attributes": dict(old["attributes"], **attributes)}
+            self.effects.append((unit, state, attributes))
+
+
+    def schedule(self, when, callback, kwargs, every=None):
+        self.seq += 1
+        heapq.heappush(self.timers, (when, self.seq, callback, kwargs, every))
+        return self.seq
+
+
+    def cancel(self, handle):
+        self.timers = [t for t in self.timers if t[1] != handle]
+        heapq.heapify(self.timers)
+
+
+    def advance(self, until):
+        """ this moves the clock forward, firing any timers that come due on the way
+        """
+        while self.timers and self.timers[0][0] <= until:
+            when, seq, callback, kwargs, every = heapq.heappop(self.timers)
+            self.clock = max(self.clock, when)
+            if every:
+                heapq.heappush(self.timers, (when + every, seq, callback, kwargs, every))
+            callback(kwargs)
+            self.settle()
+        self.clock = max(self.clock, until)
+
+
+    def replay(self, events):
+        """ this feeds recorded (time, entity, state, attributes) changes through in order
+        """
+        for when, entity, state, attributes in events:
+            self.advance(when)
+            self.setstate(entity, state, attributes)
+
+
+class FakeHass:
+    """ the parts of appdaemon's hass.Hass the app uses, backed by a Simulator
+    """
+
+    def __init__(self, sim, args):
+        self.sim = sim
+        self.args = args
+        self.name = args.get("name", "climatecontrol")
+
+    def get_state(self, entity_id=None, attribute=None, **kwargs):
+        self.sim.counts["get_state"] += 1
+        if entity_id is None:
+            return dict((k, dict(v)) for k, v in self.sim.states.items())
+        state = self.sim.states.get(entity_id)
+        if state is None:
+            return None
+        if attribute == "all":
+            return dict(state)
+        if attribute is not None:
+            return state["attributes"].get(attribute)
+        return state["state"]
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.sim.states[entity_id] = {"entity_id": entity_id, "state": state, "attributes": attributes or {}}
+
+    def call_service(self, service, **kwargs):
+        self.sim.service(service, kwargs)
+
+    def listen_state(self, callback, entity=None, attribute=None, **kwargs):
+        self.sim.listeners.setdefault(entity, []).append((attribute, callback, kwargs))
+
+    def set_textvalue(self, entity_id, value):
+        if not self.sim.rules or self.sim.rules[-1][1] != value:
+            self.sim.rules.append((self.sim.clock, value))
+        self.sim.effects.append((entity_id, value, None))
+
+    def turn_on(self, entity_id, **kwargs):
+        self.sim.effects.append((entity_id, "on", None))
+
+    def turn_off(self, entity_id, **kwargs):
+        self.sim.effects.append((entity_id, "off", None))
+
+    def log(self, msg, *args, **kwargs):
+        if self.sim.verbose:
+            print(self.sim.clock.isoformat(), msg, file=sys.stderr)
+
+    def datetime(self, aware=False):
+        # the clock runs in the local time zone
+        return self.sim.clock.astimezone() if aware else self.sim.clock
+
+    def convert_utc(self, utc):
+        return datetime.datetime.fromisoformat(utc)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self.sim.schedule(self.sim.clock + datetime.timedelta(seconds=delay), callback, kwargs)
+
+    def run_at(self, callback, start, **kwargs):
+        return self.sim.schedule(start, callback, kwargs)
+
+    def run_daily(self, callback, start, **kwargs):
+        first = datetime.datetime.combine(self.sim.clock.date(), start)
+        if first <= self.sim.clock:
+            first += datetime.timedelta(days=1)
+        return self.sim.schedule(first, callback, kwargs, every=datetime.timedelta(days=1))
+
+    def run_every(self, callback, start, interval, **kwargs):
+        if start == "now" or start is None:
+            start = self.sim.clock
+        return self.sim.schedule(start, callback, kwargs, every=datetime.timedelta(seconds=interval))
+
+    def cancel_timer(self, handle):
+        self.sim.cancel(handle)
+
+
+def loadcore():
+    """ this imports the policy on its own, it doesn't need AppDaemon or a stand in for it
+    """
+    if APPDIR not in sys.path:
+        sys.path.insert(0, APPDIR)
+    import climatecore
+    return climatecore
+
+
+def loadapp(cls="Manage_Climate"):
+    """ this imports climatecontrol with FakeHass standing in for appdaemon's hass.Hass
+    """
+    hassapi = types.ModuleType("appdaemon.plugins.hass.hassapi")
+    hassapi.Hass = FakeHass
+    for name in ("appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules["appdaemon.plugins.hass.hassapi"] = hassapi
+    loadcore()
+    import climatecontrol
+    return getattr(climatecontrol, cls)
+
+
+def parsetime(val):
+    try:
+        return datetime.datetime.fromtimestamp(float(val))
+    except ValueError:
+        return datetime.datetime.fromisoformat(val).replace(tzinfo=None)
+
+
+def loadhistory(path):
+    """ this reads a CSV or JSONL history into a time ordered list of (time, entity, state, attributes)
+    """
+    events = []
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                events.append((parsetime(row["time"]), row["entity"], row["state"], None))
+        else:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    events.append((parsetime(row["time"]), row["entity"], row["state"], row.get("attributes")))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def loadconfig(path, app=None):
+    """ this reads the app's args from apps.yaml (or a JSON file of the same shape)
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            config = json.load(f)
+        else:
+            import yaml
+            config = yaml.safe_load(f)
+    if app is None and "module" not in config:
+        app = next(name for name, section in config.items() if isinstance(section, dict) and section.get("module") == "climatecontrol")
+    return config[app] if app else config
+
+
+def simulate(events, args, cls="Manage_Climate", initial=None, verbose=False, start=None):
+    """ this runs the app over the history and returns the Simulator, with its rules and calls
+        every entity starts in its first recorded state (or as given in initial), devices start off
+        the clock starts at start, or the first event
+    """
+    App = loadapp(cls)
+    sim = Simulator(start or (events[0][0] if events else datetime.datetime.now()))
+    sim.verbose = verbose
+    for key in ("aircon", "fan", "heater", "warnlight"):
+        for unit in str(args.get(key, "")).split(","):
+            if unit.strip():
+                sim.states[unit.strip()] = {"entity_id": unit.strip(), "state": "off", "attributes": {}}
+    first = dict(initial or {})
+    for when, entity, state, attributes in events:
+        first.setdefault(entity, state)
+    for entity, state in first.items():
+        sim.states[entity] = {"entity_id": entity, "state": state, "attributes": {}}
+    app = App(sim, args)
+    app.initialize()
+    sim.settle()
+    sim.replay(events)
+    sim.app = app
+    return sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded history through Manage_Climate")
+    parser.add_argument("history", help="CSV or JSONL of recorded state changes")
+    parser.add_argument("--config", required=True, help="apps.yaml (or .json) holding the app's args")
+    parser.add_argument("--app", help="which app in the config, defaults to the first climatecontrol one")
+    parser.add_argument("--class", dest="cls", default="Manage_Climate")
+    parser.add_argument("--out", help="write the JSONL here rather than stdout")
+    parser.add_argument("--verbose", action="store_true", help="print the app's log to stderr")
+    opts = parser.parse_args()
+
+    events = loadhistory(opts.history)
+    sim = simulate(events, loadconfig(opts.config, opts.app), opts.cls, verbose=opts.verbose)
+
+    out = open(opts.out, "w") if opts.out else sys.stdout
+    lines = [(when, {"time": when.isoformat(), "rule": rule}) for when, rule in sim.rules]
+    lines += [(when, {"time": when.isoformat(), "service": service, "data": data}) for when, service, data in sim.calls]
+    for when, line in sorted(lines, key=lambda l: l[0]):
+        out.write(json.dumps(line) + "\n")
+    if out is not sys.stdout:
+        out.close()
+    print("%d events, %d rule changes, %d service calls, %d get_state calls"
+          % (len(events), len(sim.rules), sim.counts["call_service"], sim.counts["get_state"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+############################################################
+#
+# Sweeps threshold settings over recorded HA history
+#
+# the decision table is worked out with NumPy over the whole history at once,
+# one array per input resampled to a fixed step, and a grid of threshold sets
+# is shared out over a process pool, so thousands of settings take minutes
+#
+# python tools/sweep.py history.csv --config apps.yaml --range inthigh=24:28:0.5 --range intlow=16:20:0.5
+#
+############################################################
+
+############################################################
+#
+# The history and config are read the same way as tools/simulate.py.
+# Thresholds not given a --range keep their first recorded value.
+# The output is CSV, one row per valid threshold set (the six have to be in
+# order) with, over the whole history:
+#   ac_hours, fan_hours, heater_hours  device-on hours, summed over the devices of each type
+#   transitions                        changes of rule
+#   switches                           devices turned on or off
+#   minutes_outside                    minutes the inside temperature was below intlow or above inthigh
+#
+# This is the policy alone: no hysteresis, dwell, away trigger, smoothing or preconditioning,
+# and the inside temperature is as recorded, it doesn't respond to the devices
+#
+############################################################
+
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import itertools
+import sys
+import warnings
+
+import numpy as np
+
+import simulate
+
+OUTPUTS = ("ac_hours", "fan_hours", "heater_hours", "transitions", "switches", "minutes_outside")
+
+cc = None # the climatecore module, loaded once per process
+HISTORY = None # the arrays every worker sweeps over, set once per process
+
+
+def policy():
+    """ this imports the policy, without the app around it
+    """
+    global cc
+    if cc is None:
+        cc = simulate.loadcore()
+    return cc
+
+
+def resample(events, entities, start, end, step):
+    """ this turns the recorded changes of each entity into its state at every step, None before the first
+    """
+    ticks = np.arange(start, end, step)
+    out = {}
+    for entity in entities:
+        changes = [(when.timestamp(), state) for when, e, state, attributes in events if e == entity]
+        times = np.array([t for t, state in changes], dtype=float)
+        states = np.array([state for t, state in changes] + [None], dtype=object)
+        idx = np.searchsorted(times, ticks, side="right") - 1
+        out[entity] = states[idx] # -1 before the first change picks the None on the end
+    return ticks, out
+
+
+def numbers(states):
+    """ this parses states into floats, NaN where they aren't numbers
+    """
+    return np.array([np.nan if v is None else v for v in map(cc.tofloat, states)], dtype=float)
+
+
+def prepare(events, args, zone=None, step=300):
+    """ this builds the input arrays the policy needs for one zone from the history
+    """
+    zones = dict((z.get("name", "zone" + str(i)), z) for i, z in enumerate(args.get("zones") or []))
+    z = cc.Zone(zone, zones[zone], args) if zone else cc.Zone("house", args)
+    start = events[0][0].timestamp()
+    end = events[-1][0].timestamp() + step
+    ticks, states = resample(events, z.SENSORS + [args["cexttemp"], args["fhigh"], args["solarstatus"], args["presenceaway"]],
+                             start, end, step)
+    # several inside sensors are taken as their median, without the app's smoothing
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        cin = np.nanmedian(np.vstack([numbers(states[sensor]) for sensor in z.SENSORS]), axis=0)
+
+    # seconds into the day, for the windows
+    day = np.array([(t - datetime.datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+                    for t in ticks.tolist()])
+    windows = {}
+    for name, (first, last) in cc.WINDOWS.items():
+        conf = (args.get("windows") or {}).get(name) or {}
+        first, last = [cc.timeofday(t) for t in (conf.get("start", first), conf.get("end", last))]
+        first, last = [t.hour * 3600 + t.minute * 60 + t.second for t in (first, last)]
+        windows[name] = (day >= first) & (day < last) if first <= last else (day >= first) | (day < last)
+
+    return {"cin": cin, "cext": numbers(states[args["cexttemp"]]),
+            "fhigh": numbers(states[args["fhigh"]]), "solar": states[args["solarstatus"]] == "on",
+            "away": states[args["presenceaway"]] == "on", "afternoon": windows["afternoon"],
+            "curfew": windows["heater_curfew"], "precool": False, "preheat": False, "trigger": "temp", "step": step,
+            "units": {"AC": len(z.AIRCON), "FAN": len(z.FAN), "HEATER": len(z.HEATER)}}
+
+
+def setup(history):
+    """ this gives a worker process the history, once, rather than with every threshold set
+    """
+    global HISTORY
+    policy()
+    HISTORY = history
+    # the tests that don't look at a user value are the same for every threshold set
+    bits = np.zeros(len(history["cin"]), dtype=np.int64)
+    for bit, field, op, sign, ref in cc.CHECKS:
+        if ref not in cc.USERKEYS:
+            bits |= np.where(evaluate(history[field], op, sign, ref), bit, 0)
+    HISTORY["fixed"] = bits
+    # whether each rule turns each device type on, the last row is for no rule yet
+    HISTORY["on"] = dict((aftype, np.array([plan[aftype][0] == "on" for mask, name, plan in cc.COMPILED] + [False]))
+                         for aftype in ("AC", "FAN", "HEATER"))
+    HISTORY["named"] = np.array([name is not None for mask, name, plan in cc.COMPILED])
+
+
+def evaluate(val, op, sign, ref):
+    """ this is one test over the whole history, a missing reading fails it as it does in features()
+    """
+    if sign == 0:
+        return np.broadcast_to(np.asarray(val == ref), np.shape(HISTORY["cin"]))
+    with np.errstate(invalid="ignore"):
+        return op(val, ref)
+
+
+def score(th):
+    """ this runs the policy over the history with one threshold set and sums up what it did
+    """
+    h = HISTORY
+    bits = h["fixed"].copy()
+    for bit, field, op, sign, ref in cc.CHECKS:
+        if ref in cc.USERKEYS:
+            bits |= np.where(evaluate(h[field], op, sign, th[ref]), bit, 0)
+
+    # the first rule that matches, as in decide()
+    rule = np.full(len(bits), -1)
+    for i, (mask, name, plan) in enumerate(cc.COMPILED):
+        rule[(rule < 0) & (bits & mask == mask)] = i
+    # a rule with no name leaves things as they were
+    rule = np.where(h["named"][rule], rule, -1)
+    held = np.maximum.accumulate(np.where(rule >= 0, np.arange(len(rule)), -1))
+    rule = np.where(held >= 0, rule[held], -1)
+
+    hours = h["step"] / 3600.0
+    out = {}
+    switches = 0
+    for aftype, key in (("AC", "ac_hours"), ("FAN", "fan_hours"), ("HEATER", "heater_hours")):
+        on = h["on"][aftype][rule]
+        if aftype == "HEATER":
+            on = on & ~h["curfew"]
+        out[key] = round(float(on.sum()) * hours * h["units"][aftype], 2)
+        switches += int(np.count_nonzero(on[1:] != on[:-1])) * h["units"][aftype]
+    out["transitions"] = int(np.count_nonzero((rule[1:] != rule[:-1]) & (rule[:-1] >= 0)))
+    out["switches"] = switches
+    with np.errstate(invalid="ignore"):
+        outside = (h["cin"] < th["INTLOW"]) | (h["cin"] > th["INTHIGH"])
+    out["minutes_outside"] = int(np.count_nonzero(outside)) * h["step"] // 60
+    return out
+
+
+def scores(chunk):
+    return [score(th) for th in chunk]
+
+
+def grid(ranges, base):
+    """ this lists every valid threshold set from a range (or a single value) for each
+    """
+    axes = []
+    for key in cc.USERKEYS:
+        if key in ranges:
+            first, last, step = ranges[key]
+            axes.append(list(np.round(np.arange(first, last + step / 2, step), 6)))
+        else:
+            axes.append([base[key]])
+    out = []
+    for values in itertools.product(*axes):
+        try:
+            th = cc.Thresholds(**dict(zip(cc.USERKEYS, values)))
+        except ValueError:
+            continue
+        out.append(dict((key, th[key]) for key in cc.USERKEYS))
+    return out
+
+
+def parserange(val):
+    """ this reads KEY=start:stop:step or KEY=value
+    """
+    key, spec = val.split("=", 1)
+    parts = [float(x) for x in spec.split(":")]
+    if len(parts) == 1:
+        parts = [parts[0], parts[0], 1.0]
+    return key.strip().upper(), tuple(parts)
+
+
+def sweep(history, sets, workers=None, chunk=64):
+    """ this scores every threshold set, sharing them out over a pool of processes
+    """
+    chunks = [sets[i:i + chunk] for i in range(0, len(sets), chunk)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=setup, initargs=(history,)) as pool:
+        return [row for rows in pool.map(scores, chunks) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="score a grid of thresholds over recorded history")
+    parser.add_argument("history", help="CSV or JSONL of recorded state changes")
+    parser.add_argument("--config", required=True, help="apps.yaml (or .json) holding the app's args")
+    parser.add_argument("--app", help="which app in the config, defaults to the first climatecontrol one")
+    parser.add_argument("--zone", help="which zone's inside sensor and devices, defaults to the whole house")
+    parser.add_argument("--range", action="append", default=[], metavar="KEY=START:STOP:STEP",
+                        help="values to try for a threshold, or KEY=VALUE to fix it")
+    parser.add_argument("--step", type=int, default=300, help="seconds between the points the policy is worked out at")
+    parser.add_argument("--workers", type=int, help="processes, defaults to one per CPU")
+    parser.add_argument("--out", help="write the CSV here rather than stdout")
+    opts = parser.parse_args()
+
+    policy()
+    args = simulate.loadconfig(opts.config, opts.app)
+    events = simulate.loadhistory(opts.history)
+    ranges = dict(parserange(val) for val in opts.range)
+
+    # thresholds not swept keep the first value recorded for them
+    base = {}
+    for key, arg, label in cc.USERVALUES:
+        entity = args.get(arg)
+        recorded = [cc.tofloat(state) for when, e, state, attributes in events if e == entity]
+        base[key] = next((v for v in recorded if v is not None), None)
+        if base[key] is None and key not in ranges:
+            parser.error("no recorded value for %s, give it a --range" % arg)
+
+    sets = grid(ranges, base)
+    history = prepare(events, args, opts.zone, opts.step)
+    rows = sweep(history, sets, opts.workers)
+
+    out = open(opts.out, "w", newline="") if opts.out else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow([key.lower() for key in cc.USERKEYS] + list(OUTPUTS))
+    for th, row in zip(sets, rows):
+        writer.writerow([th[key] for key in cc.USERKEYS] + [row[key] for key in OUTPUTS])
+    if out is not sys.stdout:
+        out.close()
+    print("%d threshold sets over %d steps" % (len(sets), len(history["cin"])), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+############################################################
+#
+# Reads the evaluations the app keeps in its telemetry file
+#
+# the ring buffer is memory mapped, so it can be read while the app is
+# writing it, and months of decisions come out without going near the
+# AppDaemon log
+#
+# python tools/telemetry.py /config/climatecontrol.ring --since 2021-01-01 --zone house --out jan.parquet
+#
+############################################################
+
+############################################################
+#
+# The output is CSV (or Parquet if --out ends .parquet, that needs pyarrow),
+# one row per evaluation with the time, zone, rule decided on (empty where the
+# table left things as they were), trigger, the inputs, whether the rule was
+# held back by its dwell and how many service calls went to its devices.
+# --summary prints the evaluations and service calls per rule instead
+#
+############################################################
+
+import argparse
+import csv
+import datetime
+import sys
+
+import simulate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="query and export the app's telemetry")
+    parser.add_argument("ring", help="the telemetry_file the app writes")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="from this time (ISO 8601)")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, help="up to this time (ISO 8601)")
+    parser.add_argument("--zone", help="only this zone")
+    parser.add_argument("--rule", help="only this rule")
+    parser.add_argument("--summary", action="store_true", help="count evaluations and service calls per rule")
+    parser.add_argument("--out", help="write CSV or .parquet here rather than CSV to stdout")
+    opts = parser.parse_args()
+
+    cc = simulate.loadcore()
+    ring = cc.Telemetry(opts.ring)
+    rows = ring.query(opts.since, opts.until, opts.zone, opts.rule)
+
+    if opts.summary:
+        totals = {}
+        for row in rows:
+            total = totals.setdefault((row["zone"], row["rule"]), [0, 0, 0])
+            total[0] += 1
+            total[1] += row["held"]
+            total[2] += row["calls"]
+        print("%-12s %-40s %11s %6s %9s" % ("zone", "rule", "evaluations", "held", "calls"))
+        for (zone, rule), (count, held, calls) in sorted(totals.items(), key=lambda t: -t[1][0]):
+            print("%-12s %-40s %11d %6d %9d" % (zone, rule, count, held, calls))
+    elif opts.out:
+        cc.export(rows, opts.out)
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=cc.Telemetry.FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, time=row["time"].isoformat()))
+    print("%d of %d evaluations held" % (len(rows), min(ring.count, ring.capacity)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+############################################################
+#
+# Fits a thermal model of each zone to recorded HA history
+#
+# the inside temperature is taken to head for the outside at a rate set by
+# how leaky the zone is, pushed along by the ac, heaters and the sun
+#
+#   dT/dt = loss * (outside - inside) + gain_cool * ac cooling + gain_heat * ac heating
+#           + gain_heater * heaters on + gain_solar * solar + bias
+#
+# and the rates are found by least squares over the whole history at once,
+# so a year of readings refits in seconds
+#
+# python tools/thermal.py history.csv --config apps.yaml --out /config/climatecontrol_model.json
+#
+############################################################
+
+############################################################
+#
+# The history and config are read the same way as tools/simulate.py, the
+# history needs the devices' states as well as the temperatures.
+# The output is the JSON the app's precondition: model: setting reads,
+# one entry per zone (or "house" without zones) with the fitted rates per hour,
+# the samples used and the RMSE of the fitted rate in degrees per hour
+#
+############################################################
+
+import argparse
+import json
+import sys
+import time
+import warnings
+
+import numpy as np
+
+import simulate
+import sweep
+
+INPUTS = ("cool", "heat", "heater", "solar")
+
+
+def counts(states, units, on):
+    """ this is how many of the units are in one of the on states at every step
+    """
+    total = np.zeros(len(next(iter(states.values()))))
+    for unit in units:
+        total += np.isin(states[unit], on)
+    return total
+
+
+def prepare(events, args, zone=None, step=900):
+    """ this builds the columns the model is fitted to for one zone, as (rate, [drive columns])
+    """
+    cc = sweep.policy()
+    zones = dict((z.get("name", "zone" + str(i)), z) for i, z in enumerate(args.get("zones") or []))
+    z = cc.Zone(zone, zones[zone], args) if zone else cc.Zone("house", args)
+    start = events[0][0].timestamp()
+    end = events[-1][0].timestamp() + step
+    ticks, states = sweep.resample(events, z.SENSORS + z.AIRCON + z.HEATER + [args["cexttemp"], args["solarstatus"]],
+                                   start, end, step)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        cin = np.nanmedian(np.vstack([sweep.numbers(states[sensor]) for sensor in z.SENSORS]), axis=0)
+    cext = sweep.numbers(states[args["cexttemp"]])
+
+    # what's driving it over each step is what it was at the start of the step
+    drive = {"cool": counts(states, z.AIRCON, ["cool"]), "heat": counts(states, z.AIRCON, ["heat"]),
+             "heater": counts(states, z.HEATER, ["heat", "heat_cool", "auto", "on"]),
+             "solar": (states[args["solarstatus"]] == "on").astype(float)}
+    rate = (cin[1:] - cin[:-1]) * 3600.0 / step
+    columns = [cext[:-1] - cin[:-1]] + [drive[key][:-1] for key in INPUTS] + [np.ones(len(rate))]
+    return rate, columns
+
+
+def fit(rate, columns):
+    """ this finds the rates by least squares, leaving out the steps with a missing reading
+    """
+    X = np.column_stack(columns)
+    keep = np.isfinite(rate) & np.isfinite(X).all(axis=1)
+    X, y = X[keep], rate[keep]
+    if len(y) < len(columns):
+        raise ValueError("only %d usable steps" % len(y))
+    coef = np.linalg.lstsq(X, y, rcond=None)[0]
+    rmse = float(np.sqrt(np.mean((X @ coef - y) ** 2)))
+    return {"loss": round(float(coef[0]), 6),
+            "gains": dict((key, round(float(c), 6)) for key, c in zip(INPUTS, coef[1:-1])),
+            "bias": round(float(coef[-1]), 6), "rmse": round(rmse, 4), "samples": int(len(y))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fit a thermal model of each zone to recorded history")
+    parser.add_argument("history", help="CSV or JSONL of recorded state changes")
+    parser.add_argument("--config", required=True, help="apps.yaml (or .json) holding the app's args")
+    parser.add_argument("--app", help="which app in the config, defaults to the first climatecontrol one")
+    parser.add_argument("--step", type=int, default=900, help="seconds between the points the rate of change is taken over")
+    parser.add_argument("--out", help="write the JSON here rather than stdout")
+    opts = parser.parse_args()
+
+    args = simulate.loadconfig(opts.config, opts.app)
+    events = simulate.loadhistory(opts.history)
+    names = [z.get("name", "zone" + str(i)) for i, z in enumerate(args.get("zones") or [])]
+
+    began = time.perf_counter()
+    models = {}
+    for name in names or [None]:
+        try:
+            models[name or "house"] = fit(*prepare(events, args, name, opts.step))
+        except ValueError as e:
+            print("%s not fitted: %s" % (name or "house", e), file=sys.stderr)
+
+    out = open(opts.out, "w") if opts.out else sys.stdout
+    json.dump(models, out, indent=1, sort_keys=True)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
+    print("%d zone(s) fitted from %d events in %.1fs" % (len(models), len(events), time.perf_counter() - began), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()